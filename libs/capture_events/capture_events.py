@@ -1,33 +1,948 @@
 # Copyright 2022 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import asyncio
+import itertools
+import json
+from collections import Counter, deque
 from contextlib import contextmanager
-from typing import Generic, Iterator, Optional, Type, TypeVar
+from pathlib import Path
+from time import perf_counter, perf_counter_ns, thread_time
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    FrozenSet,
+    Generic,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
 
 from ops.charm import CharmBase
-from ops.framework import EventBase
+from ops.framework import EventBase, Framework, Handle, Object
 
 _T = TypeVar("_T", bound=EventBase)
 
 
+class _Subscription:
+    """A callback interested in events of some types."""
+
+    __slots__ = ("types", "callback")
+
+    def __init__(self, types: Tuple[Type[EventBase], ...], callback: Callable):
+        self.types = types
+        self.callback = callback
+
+
+class _Dispatcher:
+    """Wraps `framework._emit`, fanning emitted events out to all subscriptions.
+
+    There is at most one per framework, however many captures are active on it.
+    Which subscriptions an event goes to is worked out once per event class.
+    """
+
+    def __init__(self, framework: Framework):
+        self._framework = framework
+        self._real_emit = framework._emit
+        self._subscriptions: List[_Subscription] = []
+        # {event class: subscriptions it should be dispatched to}
+        self._routes: Dict[Type[EventBase], Tuple[_Subscription, ...]] = {}
+
+    @staticmethod
+    def get(framework: Framework) -> "_Dispatcher":
+        """Get the dispatcher of `framework`; install it if there's none yet."""
+        emit = vars(framework).get("_emit")
+        if isinstance(emit, _Dispatcher):
+            return emit
+        dispatcher = _Dispatcher(framework)
+        framework._emit = dispatcher  # type: ignore # noqa # ugly
+        return dispatcher
+
+    def __call__(self, evt: EventBase):
+        subscriptions = self._routes.get(type(evt))
+        if subscriptions is None:
+            subscriptions = self._route(type(evt))
+        for subscription in subscriptions:
+            subscription.callback(evt)
+        return self._real_emit(evt)
+
+    def _route(self, event_type: Type[EventBase]) -> Tuple[_Subscription, ...]:
+        routes = self._routes[event_type] = tuple(
+            s for s in self._subscriptions if issubclass(event_type, s.types)
+        )
+        return routes
+
+    def subscribe(self, subscription: _Subscription):
+        """Start dispatching events to `subscription`."""
+        self._subscriptions.append(subscription)
+        self._routes.clear()
+
+    def unsubscribe(self, subscription: _Subscription):
+        """Stop dispatching events to `subscription`."""
+        self._subscriptions.remove(subscription)
+        self._routes.clear()
+        if not self._subscriptions and vars(self._framework).get("_emit") is self:
+            self._framework._emit = self._real_emit  # type: ignore # noqa # ugly
+
+
+@contextmanager
+def _subscribed(
+    charm: CharmBase, callback: Callable, types: Tuple[Type[EventBase], ...]
+):
+    dispatcher = _Dispatcher.get(charm.framework)
+    subscription = _Subscription(types or (EventBase,), callback)
+    dispatcher.subscribe(subscription)
+    try:
+        yield
+    finally:
+        dispatcher.unsubscribe(subscription)
+
+
+class EventSnapshot:
+    """Lightweight record of an event.
+
+    Unlike the event itself, it does not keep the framework (and therefore
+    the charm, the harness, ...) alive.
+    """
+
+    __slots__ = (
+        "event_type",
+        "handle_path",
+        "snapshot",
+        "relation_name",
+        "relation_id",
+        "unit_name",
+        "app_name",
+    )
+
+    def __init__(
+        self,
+        event_type: Type[EventBase],
+        handle_path: str,
+        snapshot: Optional[Dict[str, Any]] = None,
+        relation_name: Optional[str] = None,
+        relation_id: Optional[int] = None,
+        unit_name: Optional[str] = None,
+        app_name: Optional[str] = None,
+    ):
+        self.event_type = event_type
+        self.handle_path = handle_path
+        self.snapshot = snapshot
+        self.relation_name = relation_name
+        self.relation_id = relation_id
+        self.unit_name = unit_name
+        self.app_name = app_name
+
+    @classmethod
+    def from_event(cls, evt: EventBase) -> "EventSnapshot":
+        """Take a snapshot of `evt`."""
+        relation = getattr(evt, "relation", None)
+        unit = getattr(evt, "unit", None)
+        app = getattr(evt, "app", None)
+        return cls(
+            type(evt),
+            evt.handle.path,
+            evt.snapshot(),
+            relation.name if relation else None,
+            relation.id if relation else None,
+            unit.name if unit else None,
+            app.name if app else None,
+        )
+
+    @property
+    def kind(self) -> str:
+        """The event kind, e.g. 'config_changed'."""
+        return self.handle_path.rsplit("/", 1)[-1].split("[", 1)[0]
+
+    def __repr__(self):
+        return f"<EventSnapshot {self.event_type.__name__} {self.handle_path}>"
+
+
+@contextmanager
+def capture_events(
+    charm: CharmBase,
+    *types: Type[EventBase],
+    maxlen: Optional[int] = None,
+    count_only: bool = False,
+    snapshot: bool = False,
+):
+    """Capture all events of type `*types` (using instance checks).
+
+    Yields a list of the captured events, unless:
+     - `maxlen` is given: then it's a deque holding only the last `maxlen` events.
+     - `count_only` is set: then it's a Counter of how many events of each
+       (exact) type were emitted; events themselves are not kept.
+    If `snapshot` is set, the list (or deque) holds an EventSnapshot of each
+    event instead of the event itself.
+    `count_only` can't be combined with `maxlen` or `snapshot`.
+    """
+    if count_only and (maxlen is not None or snapshot):
+        raise ValueError("count_only keeps no events: can't use maxlen or snapshot")
+    if count_only:
+        captured: Union[List, Deque, Counter] = Counter()
+
+        def _count(evt: EventBase):
+            captured[type(evt)] += 1
+
+        callback = _count
+    else:
+        captured = [] if maxlen is None else deque(maxlen=maxlen)
+        callback = captured.append
+        if snapshot:
+            append = captured.append
+
+            def _snapshot(evt: EventBase):
+                append(EventSnapshot.from_event(evt))
+
+            callback = _snapshot
+
+    with _subscribed(charm, callback, types):
+        yield captured
+
+
+@contextmanager
+def subscribe(
+    charm: CharmBase, callback: Callable[[EventBase], None], *types: Type[EventBase]
+):
+    """Call `callback` with every event of type `*types`, as soon as it is emitted.
+
+    The callback runs before the event reaches any observer. If it raises,
+    the event is not emitted and the error propagates to whatever emitted it,
+    so a test can abort on the first unexpected event.
+    """
+    with _subscribed(charm, callback, types):
+        yield
+
+
+class EventStream:
+    """Events of interest, available as soon as they are emitted.
+
+    Iterating over the stream yields the events emitted so far which have not
+    been consumed yet; consumed events are not kept around. Iterating over it
+    asynchronously (`async for`) waits for new events until the stream is
+    closed, which happens when the `stream_events` context exits.
+    """
+
+    def __init__(self):
+        self._pending: Deque[EventBase] = deque()
+        self._closed = False
+        self._waiter: Optional[asyncio.Future] = None
+
+    def _push(self, evt: EventBase):
+        self._pending.append(evt)
+        self._wake()
+
+    def close(self):
+        """Stop waiting for new events."""
+        self._closed = True
+        self._wake()
+
+    def _wake(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            # we may be called from a thread other than the loop's one
+            waiter.get_loop().call_soon_threadsafe(_resolve, waiter)
+
+    def __iter__(self) -> Iterator[EventBase]:
+        while self._pending:
+            yield self._pending.popleft()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> EventBase:
+        while not self._pending:
+            if self._closed:
+                raise StopAsyncIteration
+            waiter = self._waiter = asyncio.get_running_loop().create_future()
+            # events may be pushed from another thread: one pushed before the
+            # waiter was published would not wake it, so look again
+            if self._pending or self._closed:
+                self._waiter = None
+                continue
+            await waiter
+        return self._pending.popleft()
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+@contextmanager
+def stream_events(charm: CharmBase, *types: Type[EventBase]) -> Iterator[EventStream]:
+    """Stream all events of type `*types` (using instance checks).
+
+    Example usage:
+    >>> with stream_events(charm, RelationEvent) as stream:
+    >>>     harness.add_relation('foo', 'remote')
+    >>>     created, = stream
+    >>>     harness.add_relation_unit(created.relation.id, 'remote/0')
+    >>>     joined, = stream
+    """
+    stream = EventStream()
+    try:
+        with _subscribed(charm, stream._push, types):
+            yield stream
+    finally:
+        stream.close()
+
+
+class TappedEvent(NamedTuple):
+    """An event seen by an EventTap."""
+
+    seq: int
+    """Position in the tap's stream, across all frameworks."""
+    time: int
+    """When the event was emitted, in `perf_counter_ns` nanoseconds."""
+    tag: str
+    """Tag of the framework the event was emitted on."""
+    event: Union[EventBase, EventSnapshot]
+
+    @property
+    def kind(self) -> str:
+        """The event kind, e.g. 'config_changed'."""
+        if isinstance(self.event, EventSnapshot):
+            return self.event.kind
+        return self.event.handle.kind
+
+
+class EventTap:
+    """Merge the events of type `*types` emitted on many frameworks into one stream.
+
+    Events are appended to `events` as TappedEvents, numbered, timestamped
+    and tagged with the charm they come from. Appending takes no lock, so
+    harnesses may run in different threads; but then events may be appended
+    out of `seq` (and `time`) order: use `ordered` to get them sorted by
+    `seq`. With `maxlen`, only the last `maxlen` events are kept; with
+    `snapshot`, EventSnapshots are kept instead of the events themselves.
+
+    Example usage:
+    >>> with EventTap(RelationEvent) as tap:
+    >>>     for harness in harnesses:
+    >>>         tap.attach(harness.charm, tag=harness.charm.unit.name)
+    >>>     ...  # exchange relation data
+    >>> for seq, time, tag, event in tap.ordered():
+    >>>     ...
+    """
+
+    def __init__(
+        self,
+        *types: Type[EventBase],
+        maxlen: Optional[int] = None,
+        snapshot: bool = False,
+    ):
+        self.events: Deque[TappedEvent] = deque(maxlen=maxlen)
+        self._types = types or (EventBase,)
+        self._snapshot = snapshot
+        self._seq = itertools.count()
+        # {tag: (dispatcher, subscription)}
+        self._attached: Dict[str, Tuple[_Dispatcher, _Subscription]] = {}
+
+    def attach(self, charm: CharmBase, tag: Optional[str] = None) -> str:
+        """Start tapping the framework of `charm`; return its tag.
+
+        The tag defaults to the name of the charm's unit.
+        """
+        tag = charm.unit.name if tag is None else tag
+        if tag in self._attached:
+            raise ValueError(f"{tag!r} is attached already")
+
+        # bound once: each event then only costs a few C calls
+        append = self.events.append
+        next_seq = self._seq.__next__
+        now = perf_counter_ns
+        if self._snapshot:
+            from_event = EventSnapshot.from_event
+
+            def _tap(evt: EventBase):
+                append(TappedEvent(next_seq(), now(), tag, from_event(evt)))
+
+        else:
+
+            def _tap(evt: EventBase):
+                append(TappedEvent(next_seq(), now(), tag, evt))
+
+        dispatcher = _Dispatcher.get(charm.framework)
+        subscription = _Subscription(self._types, _tap)
+        dispatcher.subscribe(subscription)
+        self._attached[tag] = (dispatcher, subscription)
+        return tag
+
+    def detach(self, tag: str):
+        """Stop tapping the framework tagged `tag`."""
+        dispatcher, subscription = self._attached.pop(tag)
+        dispatcher.unsubscribe(subscription)
+
+    def close(self):
+        """Stop tapping all frameworks."""
+        for tag in list(self._attached):
+            self.detach(tag)
+
+    def ordered(self) -> List[TappedEvent]:
+        """Return the tapped events, sorted by `seq`."""
+        # seqs are unique, so tapped events compare by seq alone
+        return sorted(self.events)
+
+    def counts(self) -> Counter:
+        """How many events of each kind were tapped, per tag: {(tag, kind): count}."""
+        return Counter((tapped.tag, tapped.kind) for tapped in self.events)
+
+    def __enter__(self) -> "EventTap":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 @contextmanager
-def capture_events(charm: CharmBase, *types: Type[EventBase]):
-    """Capture all events of type `*types` (using instance checks)."""
-    allowed_types = types or (EventBase,)
+def record_events(
+    charm: CharmBase, path: Union[str, Path], *types: Type[EventBase]
+) -> Iterator[Path]:
+    """Record all events of type `*types` (using instance checks) to a trace file.
+
+    The trace has one json object per line, with the event type, handle path
+    and snapshot data of an event. New events are appended to `path` if it
+    exists already. See `replay_events`.
+
+    Recording never gets in the way of the event itself: if a snapshot can't
+    be serialized to json, an entry with an "error" instead of a "snapshot"
+    is recorded, and the event is emitted as usual.
+    """
+    path = Path(path)
+    with path.open("a") as trace:
+        write = trace.write
+
+        def _record(evt: EventBase):
+            record = {"type": _type_name(type(evt)), "path": evt.handle.path}
+            try:
+                line = json.dumps({**record, "snapshot": evt.snapshot()})
+            except (TypeError, ValueError) as e:
+                line = json.dumps({**record, "error": f"cannot record snapshot: {e}"})
+            write(line + "\n")
+
+        with _subscribed(charm, _record, types):
+            yield path
+
+
+def _type_name(event_type: Type[EventBase]) -> str:
+    return f"{event_type.__module__}.{event_type.__qualname__}"
+
+
+def replay_events(charm: CharmBase, path: Union[str, Path]) -> int:
+    """Emit, in order, the events recorded in a trace file by `record_events`.
+
+    Events get new handles, but their snapshot data is restored as recorded;
+    so for example a relation event can only be replayed if the relation it
+    refers to exists in the charm's model. Returns the number of events
+    emitted.
+
+    The trace is read twice, one event at a time, so it is never held in
+    memory as a whole. The first pass checks it: if any event can't be
+    replayed (its emitter can't be found, its type is not the recorded one,
+    or its snapshot could not be recorded), a ValueError is raised and
+    nothing is emitted. The second pass emits the events as it reads them.
+    """
+    framework = charm.framework
+    emitters: Dict[str, Object] = {}
+    count = 0
+    for _ in _read_trace(charm, path, emitters):
+        count += 1
 
-    captured = []
-    _real_emit = charm.framework._emit
+    # stop at the events that were checked, in case the trace is growing
+    for emitter, kind, event_type, snapshot in itertools.islice(
+        _read_trace(charm, path, emitters), count
+    ):
+        evt = event_type.__new__(event_type)
+        evt.framework = framework
+        EventBase.__init__(evt, Handle(emitter, kind, framework._next_event_key()))
+        evt.restore(snapshot)
+        framework._emit(evt)
+    return count
 
-    def _wrapped_emit(evt):
-        if isinstance(evt, allowed_types):
-            captured.append(evt)
-        return _real_emit(evt)
 
-    charm.framework._emit = _wrapped_emit  # type: ignore # noqa # ugly
+def _read_trace(
+    charm: CharmBase, path: Union[str, Path], emitters: Dict[str, Object]
+) -> Iterator[Tuple[Object, str, Type[EventBase], Any]]:
+    # yields the emitter, kind, type and snapshot of each event in a trace;
+    # emitters are cached by handle path in `emitters`
+    with Path(path).open() as trace:
+        for line in trace:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "error" in record:
+                raise ValueError(f"cannot replay {record['path']}: {record['error']}")
+            handle = Handle.from_path(record["path"])
+            assert handle.parent  # type guard
+            parent_path = handle.parent.path
 
-    yield captured
+            emitter = emitters.get(parent_path)
+            if emitter is None:
+                emitter = emitters[parent_path] = _find_emitter(charm, parent_path)
+            event_type = getattr(emitter, handle.kind).event_type
+            if _type_name(event_type) != record["type"]:
+                raise ValueError(
+                    f"cannot replay {record['path']}: it was a {record['type']}, "
+                    f"but is now a {_type_name(event_type)}"
+                )
+            yield emitter, handle.kind, event_type, record["snapshot"]
 
-    charm.framework._emit = _real_emit  # type: ignore # noqa # ugly
+
+def _find_emitter(charm: CharmBase, path: str) -> Object:
+    # the objects that can emit events are, usually, the framework, the charm
+    # and whatever observes events, and their `on` attributes.
+    framework = charm.framework
+    for obj in (framework, charm, *framework._observer.values()):
+        if obj.handle.path == path:
+            return obj
+        on = getattr(obj, "on", None)
+        if isinstance(on, Object) and on.handle.path == path:
+            return on
+    raise ValueError(f"cannot replay events emitted by {path}: no such object")
+
+
+class _Frame:
+    __slots__ = ("name", "label", "path", "wall", "cpu", "child_wall", "child_cpu")
+
+    def __init__(self, name: str, label: str, path: str):
+        self.name = name
+        self.label = label
+        self.path = path
+        self.child_wall = self.child_cpu = 0.0
+        self.wall = perf_counter()
+        self.cpu = thread_time()
+
+
+class EventProfile:
+    """Wall and cpu time spent emitting events, per event kind and per observer.
+
+    Times are inclusive for the rows of `table`/`as_dict`, and exclusive
+    (i.e. minus the time spent in nested frames) in `collapsed`.
+    """
+
+    def __init__(self):
+        self._stack: List[_Frame] = []
+        # {label: [calls, wall, cpu]}
+        self._totals: Dict[str, List[float]] = {}
+        # {(frame name, ...): [wall, cpu]}
+        self._stacks: Dict[Tuple[str, ...], List[float]] = {}
+
+    def _enter(self, name: str, label: str, evt: EventBase):
+        self._stack.append(_Frame(name, label, evt.handle.path))
+
+    def _exit(self):
+        stack = self._stack
+        frame = stack.pop()
+        wall = perf_counter() - frame.wall
+        cpu = thread_time() - frame.cpu
+
+        totals = self._totals.get(frame.label)
+        if totals is None:
+            totals = self._totals[frame.label] = [0, 0.0, 0.0]
+        totals[0] += 1
+        totals[1] += wall
+        totals[2] += cpu
+
+        key = tuple(f.name for f in stack) + (frame.name,)
+        own = self._stacks.get(key)
+        if own is None:
+            own = self._stacks[key] = [0.0, 0.0]
+        own[0] += wall - frame.child_wall
+        own[1] += cpu - frame.child_cpu
+
+        if stack:
+            stack[-1].child_wall += wall
+            stack[-1].child_cpu += cpu
+
+    def _call_observer(self, observer: str, method: Callable, evt: EventBase):
+        kind = evt.handle.kind
+        reemitted = not self._stack or self._stack[-1].path != evt.handle.path
+        if reemitted:
+            # deferred events are re-emitted (from storage) without going
+            # through _emit
+            self._enter(f"{kind} (reemitted)", f"{kind} (reemitted)", evt)
+        self._enter(observer, f"{kind} > {observer}", evt)
+        try:
+            return method(evt)
+        finally:
+            self._exit()
+            if reemitted:
+                self._exit()
+
+    def as_dict(self) -> Dict[str, Dict[str, float]]:
+        """Return calls, wall and cpu time per event kind and (event kind, observer)."""
+        return {
+            label: dict(zip(("calls", "wall", "cpu"), totals))
+            for label, totals in self._totals.items()
+        }
+
+    def table(self, sort_by: str = "wall") -> str:
+        """Render the profile as a table, sorted by 'calls', 'wall' or 'cpu'."""
+        column = ("calls", "wall", "cpu").index(sort_by)
+        rows = sorted(self._totals.items(), key=lambda item: -item[1][column])
+        width = max((len(label) for label in self._totals), default=5)
+        lines = [f"{'event':<{width}}  {'calls':>8}  {'wall (s)':>10}  {'cpu (s)':>10}"]
+        for label, (calls, wall, cpu) in rows:
+            lines.append(f"{label:<{width}}  {calls:>8}  {wall:>10.6f}  {cpu:>10.6f}")
+        return "\n".join(lines)
+
+    def collapsed(self, cpu: bool = False) -> str:
+        """Render the profile as collapsed stacks, e.g. for flamegraph.pl.
+
+        Values are wall (or cpu) times, in microseconds.
+        """
+        index = 1 if cpu else 0
+        return "\n".join(
+            f"{';'.join(stack)} {round(times[index] * 1e6)}"
+            for stack, times in self._stacks.items()
+        )
+
+
+class _ProfiledObservers:
+    """Stands in for `framework._observer`, handing out profiled observers."""
+
+    def __init__(self, observers, profile: EventProfile):
+        self._observers = observers
+        self._profile = profile
+
+    def get(self, path: str, default=None):
+        observer = self._observers.get(path, default)
+        if observer is None:
+            return None
+        return _ProfiledObserver(observer, self._profile)
+
+    def __getitem__(self, path: str):
+        return self._observers[path]
+
+    def __setitem__(self, path: str, observer: Object):
+        self._observers[path] = observer
+
+    def __contains__(self, path: str):
+        return path in self._observers
+
+    def __iter__(self):
+        return iter(self._observers)
+
+    def __len__(self):
+        return len(self._observers)
+
+    def __getattr__(self, name: str):
+        return getattr(self._observers, name)
+
+
+class _ProfiledObserver:
+    def __init__(self, observer: Object, profile: EventProfile):
+        self._observer = observer
+        self._profile = profile
+
+    def __getattr__(self, name: str):
+        method = getattr(self._observer, name, None)
+        if method is None:
+            return None
+        label = f"{type(self._observer).__name__}.{name}"
+        profile = self._profile
+
+        def _profiled(evt: EventBase):
+            return profile._call_observer(label, method, evt)
+
+        return _profiled
+
+
+@contextmanager
+def profile_events(charm: CharmBase) -> Iterator[EventProfile]:
+    """Profile the time spent emitting events, and in each observer.
+
+    Example usage:
+    >>> with profile_events(harness.charm) as profile:
+    >>>     harness.add_relation('foo', 'remote')
+    >>> print(profile.table())
+    >>> Path('./events.folded').write_text(profile.collapsed())
+    """
+    framework = charm.framework
+    profile = EventProfile()
+    real_emit = framework._emit
+    real_observers = framework._observer
+
+    def _profiled_emit(evt: EventBase):
+        kind = evt.handle.kind
+        profile._enter(kind, kind, evt)
+        try:
+            return real_emit(evt)
+        finally:
+            profile._exit()
+
+    framework._emit = _profiled_emit  # type: ignore # noqa # ugly
+    framework._observer = _ProfiledObservers(real_observers, profile)  # type: ignore
+    try:
+        yield profile
+    finally:
+        framework._observer = real_observers
+        if vars(framework).get("_emit") is _profiled_emit:
+            framework._emit = real_emit  # type: ignore # noqa # ugly
+
+
+class EventPatternMismatch(AssertionError):
+    """Raised when an event stream does not match the expected pattern."""
+
+
+class Match:
+    """Pattern matching a single event.
+
+    Matches events that are instances of `event_type` and whose attributes
+    equal the given values; nested attributes are spelled with a double
+    underscore, e.g. `Match(RelationEvent, relation__name="foo")`. Values
+    can also be predicates taking the attribute value.
+    """
+
+    def __init__(self, event_type: Type[EventBase] = EventBase, **attrs: Any):
+        self.event_type = event_type
+        self.attrs = [(name.split("__"), value) for name, value in attrs.items()]
+        reprs = [f"{name}={value!r}" for name, value in attrs.items()]
+        self._repr = ", ".join([event_type.__name__, *reprs])
+
+    def matches(self, evt: EventBase) -> bool:
+        """Return whether `evt` matches."""
+        if not isinstance(evt, self.event_type):
+            return False
+        for path, expected in self.attrs:
+            value = evt
+            for name in path:
+                value = getattr(value, name, None)
+            if callable(expected):
+                if not expected(value):
+                    return False
+            elif value != expected:
+                return False
+        return True
+
+    def __repr__(self):
+        return f"Match({self._repr})"
+
+
+class Seq:
+    """Pattern matching its sub-patterns one after the other."""
+
+    def __init__(self, *patterns: "_Pattern"):
+        self.patterns = patterns
+
+
+class Opt:
+    """Pattern matching its sub-pattern, or nothing."""
+
+    def __init__(self, pattern: "_Pattern"):
+        self.pattern = pattern
+
+
+class Repeat:
+    """Pattern matching its sub-pattern `at_least` to `at_most` (None: any) times."""
+
+    def __init__(
+        self, pattern: "_Pattern", at_least: int = 0, at_most: Optional[int] = None
+    ):
+        if at_most is not None and at_most < at_least:
+            raise ValueError(f"invalid repeat range {at_least}-{at_most}")
+        self.pattern = pattern
+        self.at_least = at_least
+        self.at_most = at_most
+
+
+class Unordered:
+    """Pattern matching all of its sub-patterns, in any order."""
+
+    def __init__(self, *patterns: "_Pattern"):
+        self.patterns = patterns
+
+
+_Pattern = Union[Type[EventBase], Match, Seq, Opt, Repeat, Unordered]
+
+
+class _State:
+    """NFA state: matches an event (if `match`), then moves on to `out`."""
+
+    __slots__ = ("match", "out")
+
+    def __init__(self, match: Optional[Match] = None, out: Tuple["_State", ...] = ()):
+        self.match = match
+        self.out = out
+
+
+class EventPattern:
+    """An event pattern, compiled to a nondeterministic finite automaton.
+
+    Example usage:
+    >>> pattern = EventPattern(
+    ...     Seq(
+    ...         ConfigChangedEvent,
+    ...         Unordered(
+    ...             Match(RelationCreatedEvent, relation__name="foo"),
+    ...             Match(RelationCreatedEvent, relation__name="bar"),
+    ...         ),
+    ...         Repeat(RelationChangedEvent, at_least=1),
+    ...         Opt(UpdateStatusEvent),
+    ...     )
+    ... )
+    >>> matcher = pattern.matcher()
+    >>> for evt in events:
+    ...     matcher.feed(evt)
+    >>> matcher.finish()
+    """
+
+    def __init__(self, pattern: "_Pattern"):
+        self.pattern = pattern
+        self.accept = _State()
+        self.start = self._compile(pattern, self.accept)
+        self.types = tuple({match.event_type for match in self._atoms()})
+
+    def _compile(self, pattern: "_Pattern", then: _State) -> _State:
+        if isinstance(pattern, type):
+            pattern = Match(pattern)
+        if isinstance(pattern, Match):
+            return _State(pattern, (then,))
+        if isinstance(pattern, Seq):
+            for sub in reversed(pattern.patterns):
+                then = self._compile(sub, then)
+            return then
+        if isinstance(pattern, Opt):
+            return _State(None, (self._compile(pattern.pattern, then), then))
+        if isinstance(pattern, Repeat):
+            if pattern.at_most is None:
+                loop = _State()
+                loop.out = (self._compile(pattern.pattern, loop), then)
+                then = loop
+            else:
+                for _ in range(pattern.at_most - pattern.at_least):
+                    then = _State(None, (self._compile(pattern.pattern, then), then))
+            for _ in range(pattern.at_least):
+                then = self._compile(pattern.pattern, then)
+            return then
+        if isinstance(pattern, Unordered):
+            # one state per subset of sub-patterns still to be matched
+            subs = pattern.patterns
+            memo: Dict[FrozenSet[int], _State] = {}
+
+            def remaining(todo: FrozenSet[int]) -> _State:
+                if not todo:
+                    return then
+                state = memo.get(todo)
+                if state is None:
+                    state = memo[todo] = _State(
+                        None,
+                        tuple(
+                            self._compile(subs[i], remaining(todo - {i})) for i in todo
+                        ),
+                    )
+                return state
+
+            return remaining(frozenset(range(len(subs))))
+        raise TypeError(pattern)
+
+    def _atoms(self) -> List[Match]:
+        seen, todo, atoms = set(), [self.start], []
+        while todo:
+            state = todo.pop()
+            if id(state) in seen:
+                continue
+            seen.add(id(state))
+            if state.match is not None:
+                atoms.append(state.match)
+            todo.extend(state.out)
+        return atoms
+
+    def matcher(self) -> "EventMatcher":
+        """Start matching an event stream."""
+        return EventMatcher(self)
+
+
+class EventMatcher:
+    """Matches events against an EventPattern, one at a time.
+
+    Only keeps track of the automaton states it is in.
+    """
+
+    def __init__(self, pattern: EventPattern):
+        self._pattern = pattern
+        self._states = self._closure((pattern.start,))
+        self._count = 0
+
+    def _closure(self, states: Iterable[_State]) -> List[_State]:
+        # follow all transitions that don't consume an event
+        seen, todo, closure = set(), list(states), []
+        while todo:
+            state = todo.pop()
+            if id(state) in seen:
+                continue
+            seen.add(id(state))
+            if state.match is not None or state is self._pattern.accept:
+                closure.append(state)
+            else:
+                todo.extend(state.out)
+        return closure
+
+    def _expected(self) -> str:
+        return "\n".join(
+            f"  - {state.match!r}" if state.match else "  - end of stream"
+            for state in self._states
+        )
+
+    def feed(self, evt: EventBase):
+        """Advance the matcher by an event; raise if it can no longer match."""
+        matched = [
+            state.out[0]
+            for state in self._states
+            if state.match is not None and state.match.matches(evt)
+        ]
+        if not matched:
+            raise EventPatternMismatch(
+                f"event #{self._count} ({evt}) does not match; "
+                f"expected one of:\n{self._expected()}"
+            )
+        self._states = self._closure(matched)
+        self._count += 1
+
+    @property
+    def complete(self) -> bool:
+        """Whether the stream would match, if it ended now."""
+        return self._pattern.accept in self._states
+
+    def finish(self):
+        """Raise if the stream, as it is now, does not match."""
+        if not self.complete:
+            raise EventPatternMismatch(
+                f"stream ended after {self._count} events; "
+                f"expected one of:\n{self._expected()}"
+            )
+
+
+@contextmanager
+def expect_events(
+    charm: CharmBase, pattern: Union[EventPattern, "_Pattern"]
+) -> Iterator[EventMatcher]:
+    """Assert that the events emitted within this context match `pattern`.
+
+    Only events of the types the pattern mentions are matched, others are
+    ignored. EventPatternMismatch is raised as soon as an event can't
+    match, from wherever the event was emitted, and on exit if the stream
+    is incomplete.
+
+    Example usage:
+    >>> with expect_events(charm, Seq(RelationCreatedEvent, Opt(RelationJoinedEvent))):
+    >>>     harness.add_relation('foo', 'remote')
+    """
+    if not isinstance(pattern, EventPattern):
+        pattern = EventPattern(pattern)
+    matcher = pattern.matcher()
+    with _subscribed(charm, matcher.feed, pattern.types):
+        yield matcher
+    matcher.finish()
 
 
 class Captured(Generic[_T]):
@@ -1,23 +1,46 @@
 # add here your unittests
+import asyncio
+import gc
 import sys
+import threading
+import weakref
 from pathlib import Path
 
 import pytest as pytest
 import yaml
 from ops.charm import (
     CharmBase,
+    CharmEvents,
     ConfigChangedEvent,
     RelationCreatedEvent,
     RelationEvent,
     RelationJoinedEvent,
 )
+from ops.framework import EventBase, EventSource
 from ops.testing import Harness
 
 lib_root = Path(__file__).parent.parent
 sys.path.append(str(lib_root))
 
 
-from capture_events import capture_events
+from capture_events import (
+    EventPattern,
+    EventSnapshot,
+    EventTap,
+    EventPatternMismatch,
+    Match,
+    Opt,
+    Repeat,
+    Seq,
+    Unordered,
+    capture_events,
+    expect_events,
+    profile_events,
+    record_events,
+    replay_events,
+    stream_events,
+    subscribe,
+)
 
 
 @pytest.fixture
@@ -47,3 +70,402 @@ def test_capture(charm, harness):
     assert isinstance(captured[1], RelationCreatedEvent)
 
     assert len(captured) == 2
+
+
+def test_nested_captures(charm, harness):
+    real_emit = charm.framework._emit
+    with capture_events(charm, ConfigChangedEvent) as config_events:
+        with capture_events(charm, RelationEvent) as relation_events:
+            with capture_events(charm) as all_events:
+                # one dispatcher for all captures
+                dispatcher = charm.framework._emit
+                harness.update_config({"foo": "bar"})
+                harness.add_relation("foo", "remote")
+            assert charm.framework._emit is dispatcher
+            harness.update_config({"foo": "baz"})
+
+    # the dispatcher is gone once the last capture is done
+    assert charm.framework._emit == real_emit
+    assert len(config_events) == 2
+    assert [type(e) for e in relation_events] == [RelationCreatedEvent]
+    assert [type(e) for e in all_events] == [ConfigChangedEvent, RelationCreatedEvent]
+
+
+def test_capture_restores_on_error(charm, harness):
+    real_emit = charm.framework._emit
+    with pytest.raises(ValueError):
+        with capture_events(charm):
+            raise ValueError()
+    assert charm.framework._emit == real_emit
+
+
+def test_capture_maxlen(charm, harness):
+    with capture_events(charm, maxlen=2) as captured:
+        for i in range(10):
+            harness.update_config({"foo": str(i)})
+        harness.add_relation("foo", "remote")
+
+    assert len(captured) == 2
+    assert isinstance(captured[0], ConfigChangedEvent)
+    assert isinstance(captured[1], RelationCreatedEvent)
+
+
+def test_capture_count_only(charm, harness):
+    with capture_events(charm, count_only=True) as captured:
+        for i in range(10):
+            harness.update_config({"foo": str(i)})
+        harness.add_relation("foo", "remote")
+
+    assert captured == {ConfigChangedEvent: 10, RelationCreatedEvent: 1}
+
+
+@pytest.mark.parametrize("kwargs", ({"maxlen": 10}, {"snapshot": True}))
+def test_capture_count_only_conflicts(charm, kwargs):
+    with pytest.raises(ValueError):
+        with capture_events(charm, count_only=True, **kwargs):
+            pass
+
+
+def test_subscribe(charm, harness):
+    class Unexpected(Exception):
+        pass
+
+    def fail_on_relation_events(evt):
+        if isinstance(evt, RelationEvent):
+            raise Unexpected(evt)
+
+    with subscribe(charm, fail_on_relation_events):
+        harness.update_config({"foo": "bar"})
+        with pytest.raises(Unexpected):
+            harness.add_relation("foo", "remote")
+
+
+def test_stream_events(charm, harness):
+    with stream_events(charm, RelationEvent) as stream:
+        relation_id = harness.add_relation("foo", "remote")
+        (created,) = stream
+        assert isinstance(created, RelationCreatedEvent)
+        assert list(stream) == []
+
+        harness.add_relation_unit(relation_id, "remote/0")
+        (joined,) = stream
+        assert isinstance(joined, RelationJoinedEvent)
+
+
+def test_stream_events_async(charm, harness):
+    async def consume():
+        loop = asyncio.get_running_loop()
+        seen = []
+        with stream_events(charm, ConfigChangedEvent) as stream:
+            for i in range(3):
+                loop.call_soon(harness.update_config, {"foo": str(i)})
+            async for evt in stream:
+                seen.append(evt)
+                if len(seen) == 3:
+                    break
+        return seen
+
+    assert len(asyncio.run(consume())) == 3
+
+
+def test_stream_events_async_race(charm, harness):
+    async def consume(stream):
+        loop = asyncio.get_running_loop()
+
+        def racing_create_future():
+            # an event comes in from another thread just before the
+            # consumer starts waiting for one
+            del loop.create_future
+            thread = threading.Thread(target=harness.update_config, args=({"foo": "bar"},))
+            thread.start()
+            thread.join()
+            return loop.create_future()
+
+        async def next_event():
+            loop.create_future = racing_create_future
+            return await stream.__anext__()
+
+        task = loop.create_task(next_event())
+        done, _ = await asyncio.wait({task}, timeout=1)
+        assert done, "missed the event"
+        return task.result()
+
+    with stream_events(charm, ConfigChangedEvent) as stream:
+        assert isinstance(asyncio.run(consume(stream)), ConfigChangedEvent)
+
+
+def test_capture_snapshots():
+    class Charm(CharmBase):
+        pass
+
+    def run():
+        harness = Harness(
+            Charm,
+            meta=yaml.safe_dump({"requires": {"foo": {"interface": "foo"}}}),
+        )
+        harness.begin()
+        with capture_events(harness.charm, RelationEvent, snapshot=True) as captured:
+            relation_id = harness.add_relation("foo", "remote")
+            harness.add_relation_unit(relation_id, "remote/0")
+        return captured, weakref.ref(harness.framework)
+
+    captured, framework = run()
+    gc.collect()
+    # the snapshots don't keep the framework alive
+    assert framework() is None
+
+    created, joined = captured
+    assert created.event_type is RelationCreatedEvent
+    assert created.kind == "foo_relation_created"
+    assert created.relation_name == "foo"
+    assert created.app_name == "remote"
+    assert created.unit_name is None
+    assert joined.unit_name == "remote/0"
+    assert joined.snapshot["unit_name"] == "remote/0"
+    assert joined.handle_path == "Charm/on/foo_relation_joined[2]"
+
+
+def test_record_replay(tmp_path):
+    class Charm(CharmBase):
+        def __init__(self, framework, key=None):
+            super().__init__(framework, key)
+            self.seen = []
+            for evt in (self.on.config_changed, self.on.foo_relation_changed):
+                self.framework.observe(evt, self._on_event)
+
+        def _on_event(self, evt):
+            self.seen.append(evt.handle.kind)
+
+    def harness():
+        h = Harness(
+            Charm,
+            meta=yaml.safe_dump({"requires": {"foo": {"interface": "foo"}}}),
+            config=yaml.safe_dump({"options": {"foo": {"type": "string"}}}),
+        )
+        relation_id = h.add_relation("foo", "remote")
+        h.add_relation_unit(relation_id, "remote/0")
+        h.begin()
+        return h, relation_id
+
+    trace = tmp_path / "trace.jsonl"
+    original, relation_id = harness()
+    with record_events(original.charm, trace, ConfigChangedEvent):
+        original.update_config({"foo": "bar"})
+    # traces can be appended to
+    with record_events(original.charm, trace, RelationEvent):
+        original.update_relation_data(relation_id, "remote/0", {"foo": "bar"})
+
+    replayed, _ = harness()
+    with capture_events(replayed.charm) as captured:
+        assert replay_events(replayed.charm, trace) == 2
+
+    assert replayed.charm.seen == original.charm.seen
+    assert replayed.charm.seen == ["config_changed", "foo_relation_changed"]
+    assert captured[1].unit.name == "remote/0"
+
+    # events recorded while replaying are not replayed in turn
+    with record_events(replayed.charm, trace, ConfigChangedEvent, RelationEvent):
+        assert replay_events(replayed.charm, trace) == 2
+    assert len(replayed.charm.seen) == 4
+    assert len(trace.read_text().splitlines()) == 4
+
+
+def test_record_replay_framework_and_errors(tmp_path):
+    class BytesEvent(EventBase):
+        def __init__(self, handle, data=b""):
+            super().__init__(handle)
+            self.data = data
+
+        def snapshot(self):
+            return {"data": self.data}
+
+        def restore(self, snapshot):
+            self.data = snapshot["data"]
+
+    class Events(CharmEvents):
+        bytes_event = EventSource(BytesEvent)
+
+    class Charm(CharmBase):
+        on = Events()
+
+        def __init__(self, framework, key=None):
+            super().__init__(framework, key)
+            self.seen = []
+            for evt in (self.on.update_status, self.on.bytes_event):
+                self.framework.observe(evt, self._on_event)
+
+        def _on_event(self, evt):
+            self.seen.append(evt.handle.kind)
+
+    def harness():
+        h = Harness(Charm, meta=yaml.safe_dump({"name": "foo"}))
+        h.begin()
+        return h
+
+    trace = tmp_path / "trace.jsonl"
+    original = harness()
+    with record_events(original.charm, trace):
+        original.charm.on.update_status.emit()
+        original.framework.commit()
+    # framework events are replayed too
+    replayed = harness()
+    with capture_events(replayed.charm) as captured:
+        assert replay_events(replayed.charm, trace) == 3
+    assert [e.handle.kind for e in captured] == ["update_status", "pre_commit", "commit"]
+
+    # events whose snapshot can't be recorded are still emitted...
+    with record_events(original.charm, trace):
+        original.charm.on.bytes_event.emit(b"foo")
+    assert original.charm.seen == ["update_status", "bytes_event"]
+    # ...but the trace can't be replayed: nothing is emitted
+    replayed = harness()
+    with pytest.raises(ValueError, match="cannot record snapshot"):
+        replay_events(replayed.charm, trace)
+    assert replayed.charm.seen == []
+
+
+def test_profile_events():
+    class Charm(CharmBase):
+        def __init__(self, framework, key=None):
+            super().__init__(framework, key)
+            self.deferred = False
+            self.framework.observe(self.on.config_changed, self._on_config_changed)
+            self.framework.observe(self.on.update_status, self._on_update_status)
+
+        def _on_config_changed(self, evt):
+            self.on.update_status.emit()
+
+        def _on_update_status(self, evt):
+            if not self.deferred:
+                self.deferred = True
+                evt.defer()
+
+    harness = Harness(Charm)
+    harness.begin()
+    with profile_events(harness.charm) as profile:
+        harness.charm.on.config_changed.emit()
+        harness.framework.reemit()
+
+    stats = profile.as_dict()
+    assert set(stats) == {
+        "config_changed",
+        "config_changed > Charm._on_config_changed",
+        "update_status",
+        "update_status > Charm._on_update_status",
+        "update_status (reemitted)",
+    }
+    assert stats["update_status > Charm._on_update_status"]["calls"] == 2
+    assert stats["config_changed"]["wall"] >= stats["update_status"]["wall"]
+
+    table = profile.table()
+    assert table.splitlines()[1].startswith("config_changed ")
+
+    stacks = [line.rsplit(" ", 1)[0] for line in profile.collapsed().splitlines()]
+    assert stacks == [
+        "config_changed;Charm._on_config_changed;update_status;Charm._on_update_status",
+        "config_changed;Charm._on_config_changed;update_status",
+        "config_changed;Charm._on_config_changed",
+        "config_changed",
+        "update_status (reemitted);Charm._on_update_status",
+        "update_status (reemitted)",
+    ]
+
+
+def test_event_pattern():
+    class Charm(CharmBase):
+        pass
+
+    harness = Harness(
+        Charm,
+        meta=yaml.safe_dump(
+            {"requires": {"foo": {"interface": "foo"}, "bar": {"interface": "bar"}}}
+        ),
+        config=yaml.safe_dump({"options": {"foo": {"type": "string"}}}),
+    )
+    harness.begin()
+
+    pattern = EventPattern(
+        Seq(
+            Repeat(ConfigChangedEvent, at_least=1),
+            Unordered(
+                Match(RelationCreatedEvent, relation__name="foo"),
+                Match(RelationCreatedEvent, relation__name="bar"),
+            ),
+            Opt(Match(RelationJoinedEvent, unit__name="remote/0")),
+        )
+    )
+    with expect_events(harness.charm, pattern) as matcher:
+        harness.update_config({"foo": "1"})
+        harness.update_config({"foo": "2"})
+        harness.add_relation("bar", "remote")
+        assert not matcher.complete
+        relation_id = harness.add_relation("foo", "remote")
+        assert matcher.complete
+        harness.add_relation_unit(relation_id, "remote/0")
+
+    # fails as soon as the stream can no longer match
+    with pytest.raises(EventPatternMismatch) as exc:
+        with expect_events(harness.charm, pattern):
+            harness.update_config({"foo": "3"})
+            harness.add_relation("foo", "remote")
+            harness.add_relation("foo", "remote")
+            assert False, "unreachable"
+    assert "Match(RelationCreatedEvent, relation__name='bar')" in str(exc.value)
+
+    # and on exit, if the stream is incomplete
+    with pytest.raises(EventPatternMismatch) as exc:
+        with expect_events(harness.charm, pattern):
+            harness.update_config({"foo": "4"})
+    assert "stream ended after 1 events" in str(exc.value)
+
+
+def test_event_pattern_repeat():
+    pattern = EventPattern(Seq(Repeat(ConfigChangedEvent, 1, 2), RelationEvent))
+    assert len(pattern._atoms()) == 3
+
+    config_changed = ConfigChangedEvent(None)
+    matcher = pattern.matcher()
+    matcher.feed(config_changed)
+    matcher.feed(config_changed)
+    with pytest.raises(EventPatternMismatch):
+        matcher.feed(config_changed)
+
+
+def test_event_tap():
+    class Charm(CharmBase):
+        pass
+
+    def harness(unit):
+        h = Harness(
+            Charm,
+            meta=yaml.safe_dump(
+                {"name": "app", "requires": {"foo": {"interface": "foo"}}}
+            ),
+        )
+        h.begin()
+        return h
+
+    harnesses = [harness(unit) for unit in range(3)]
+    with EventTap(RelationEvent, snapshot=True) as tap:
+        tags = [tap.attach(h.charm, tag=f"app/{i}") for i, h in enumerate(harnesses)]
+        with pytest.raises(ValueError):
+            tap.attach(harnesses[0].charm, tag="app/0")
+
+        for h in harnesses:
+            relation_id = h.add_relation("foo", "remote")
+            h.add_relation_unit(relation_id, "remote/0")
+        tap.detach("app/2")
+        harnesses[2].add_relation("foo", "remote")
+
+    harnesses[0].add_relation("foo", "remote")  # closed: not tapped
+    assert [tapped.seq for tapped in tap.events] == list(range(6))
+    assert [tapped.tag for tapped in tap.events] == [t for t in tags for _ in "cj"]
+    times = [tapped.time for tapped in tap.events]
+    assert times == sorted(times)
+    assert all(isinstance(tapped.event, EventSnapshot) for tapped in tap.events)
+    assert tap.counts()["app/1", "foo_relation_joined"] == 1
+    assert sum(tap.counts().values()) == 6
+
+    # appends from different threads may interleave
+    tap.events.rotate(3)
+    assert [tapped.seq for tapped in tap.ordered()] == list(range(6))
@@ -1,30 +1,87 @@
+import asyncio
+import copy
+import inspect
+import os
+import pickle
+import sqlite3
+import threading
+import traceback
 import typing
-from typing import Callable, Protocol, Type
+from collections import Counter, deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Protocol,
+    Tuple,
+    Type,
+)
 
-from ops.charm import CharmBase, CharmEvents
-from ops.framework import BoundEvent, Handle
+from ops.charm import CharmBase, CharmEvents, CharmMeta
+from ops.framework import BoundEvent, Handle, StoredStateData
+from ops.model import Model, StatusBase
+from ops.storage import NoSnapshotError, SQLiteStorage
 from ops.testing import Harness
 
+if typing.TYPE_CHECKING:
+    from ops.testing import RawConfig
+
 
 class _HasOn(Protocol):
     @property
-    def on(self) -> CharmEvents:
-        ...
+    def on(self) -> CharmEvents: ...
 
 
 def _DefaultEmitter(charm: CharmBase, harness: Harness):
     return charm
 
 
+class DeferralStats(NamedTuple):
+    """Outcome of `Emitter.settle`.
+
+    `reemissions` counts, per event kind, how many times a deferred event of
+    that kind was re-emitted to an observer; `pending` is the number of
+    notices (deferred event, observer) still left once done.
+    """
+
+    iterations: int
+    reemissions: typing.Counter[str]
+    pending: int
+    converged: bool
+
+
 class Emitter:
-    """Event emitter."""
+    """Event emitter.
 
-    def __init__(self, harness: Harness, emit: Callable[[], BoundEvent]):
-        self.harness = harness
+    The harness is only built (and begun) the first time `harness` is
+    accessed or the event is emitted.
+    """
+
+    def __init__(
+        self, harness: Callable[[], Harness], emit: Callable[[Harness], BoundEvent]
+    ):
+        self._get_harness = harness
+        self._harness: Optional[Harness] = None
         self._emit = emit
         self.event = None
         self._emitted = False
 
+    @property
+    def harness(self) -> Harness:
+        """The harness the event is emitted on."""
+        if self._harness is None:
+            self._harness = self._get_harness()
+        return self._harness
+
     @property
     def emitted(self):
         """Has the event been emitted already?"""  # noqa
@@ -36,10 +93,372 @@ class Emitter:
         Will get called automatically when HarnessCtx exits if you didn't call it already.
         """
         assert not self._emitted, "already emitted; should not emit twice"
-        self.event = self._emit()
+        self.event = self._emit(self.harness)
         self._emitted = True
         return self.event
 
+    def settle(self, limit: int = 100) -> DeferralStats:
+        """Re-emit deferred events until none are left, or for `limit` rounds.
+
+        Each round is what would happen at the start of the next hook: every
+        deferred event is re-emitted to the observers that deferred it.
+        """
+        framework = self.harness.framework
+        reemissions: typing.Counter[str] = Counter()
+        iterations = 0
+        notices = list(framework._storage.notices(None))
+        while notices and iterations < limit:
+            reemissions.update(Handle.from_path(path).kind for path, _, _ in notices)
+            framework.reemit()
+            iterations += 1
+            notices = list(framework._storage.notices(None))
+        return DeferralStats(iterations, reemissions, len(notices), not notices)
+
+
+class CharmSpecCache:
+    """Cache of parsed charm metadata, actions and config.
+
+    Harnesses built through this cache only parse the yaml for a given
+    charm once. Yaml passed as strings is cached by content; yaml read from
+    the charm directory (`metadata.yaml`, `actions.yaml`, `config.yaml`) is
+    cached until those files are modified.
+
+    Example usage, in a session-scoped fixture or at module level:
+    >>> specs = CharmSpecCache()
+    >>> with HarnessCtx(MyCharm, "start", spec_cache=specs) as h:
+    >>>     ...
+    """
+
+    def __init__(self):
+        # {(charm class, metadata key, actions key): (CharmMeta, charm_dir)}
+        self._meta: Dict[tuple, Tuple[CharmMeta, Any]] = {}
+        # {(charm class, config key): (raw config, charm_dir)}
+        self._config: Dict[tuple, Tuple["RawConfig", Any]] = {}
+
+    def harness(self, charm: Type[CharmBase], **kwargs) -> Harness:
+        """Build a Harness for `charm`, using this cache; see `Harness`."""
+        return _CachedHarness(charm, spec_cache=self, **kwargs)
+
+    def clear(self):
+        """Forget all cached specs."""
+        self._meta.clear()
+        self._config.clear()
+
+    @staticmethod
+    def _key(charm: Type[CharmBase], source: Any, filename: str) -> Optional[tuple]:
+        if isinstance(source, str):
+            return ("yaml", source)
+        if source is not None:
+            return None  # file-like objects can't be cached
+        path = Path(inspect.getfile(charm)).parents[1] / filename
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return ("file", str(path), None)
+        return ("file", str(path), stat.st_mtime_ns, stat.st_size)
+
+
+class _CachedHarness(Harness):
+    """Harness getting its parsed metadata and config from a CharmSpecCache."""
+
+    def __init__(
+        self, charm_cls: Type[CharmBase], *, spec_cache: CharmSpecCache, **kwargs
+    ):
+        self._spec_cache = spec_cache
+        super().__init__(charm_cls, **kwargs)
+
+    def _create_meta(self, charm_metadata, action_metadata) -> CharmMeta:
+        cache = self._spec_cache
+        meta_key = cache._key(self._charm_cls, charm_metadata, "metadata.yaml")
+        actions_key = cache._key(self._charm_cls, action_metadata, "actions.yaml")
+        if meta_key is None or actions_key is None:
+            return super()._create_meta(charm_metadata, action_metadata)
+
+        key = (self._charm_cls, meta_key, actions_key)
+        cached = cache._meta.get(key)
+        if cached is None:
+            meta = super()._create_meta(charm_metadata, action_metadata)
+            cached = cache._meta[key] = (meta, self._charm_dir)
+        self._charm_dir = cached[1]
+        return cached[0]
+
+    def _get_config(self, charm_config) -> "RawConfig":
+        cache = self._spec_cache
+        config_key = cache._key(self._charm_cls, charm_config, "config.yaml")
+        if config_key is None:
+            return super()._get_config(charm_config)
+
+        key = (self._charm_cls, config_key)
+        cached = cache._config.get(key)
+        if cached is None:
+            charm_dir = self._charm_dir
+            config = super()._get_config(charm_config)
+            # only record the charm dir if it was found thanks to config.yaml
+            cached = cache._config[key] = (
+                config,
+                self._charm_dir if self._charm_dir != charm_dir else None,
+            )
+        if cached[1] is not None:
+            self._charm_dir = cached[1]
+        return cached[0]
+
+
+class _MemoryStorage:
+    """Dict-backed framework storage, with the same interface as SQLiteStorage.
+
+    Snapshots are copied, not pickled, when saved and again when loaded, so
+    neither the objects they come from nor those restored from them share
+    state with what is stored (e.g. StoredState snapshots are its live data).
+    """
+
+    def __init__(self):
+        self._snapshots: Dict[str, Any] = {}
+        # (event path, observer path, method name), in the order they were saved
+        self._notices: List[Tuple[str, str, str]] = []
+
+    def close(self):
+        """Part of the Storage API, close the storage backend."""
+
+    def commit(self):
+        """Part of the Storage API, commit latest changes in the storage backend."""
+
+    def save_snapshot(self, handle_path: str, snapshot_data: Any) -> None:
+        """Part of the Storage API, persist a snapshot data under the given handle."""
+        self._snapshots[handle_path] = copy.deepcopy(snapshot_data)
+
+    def load_snapshot(self, handle_path: str) -> Any:
+        """Part of the Storage API, retrieve a snapshot that was previously saved."""
+        try:
+            return copy.deepcopy(self._snapshots[handle_path])
+        except KeyError:
+            raise NoSnapshotError(handle_path) from None
+
+    def drop_snapshot(self, handle_path: str):
+        """Part of the Storage API, remove a snapshot that was previously saved."""
+        self._snapshots.pop(handle_path, None)
+
+    def list_snapshots(self) -> Iterator[str]:
+        """Return the name of all snapshots that are currently saved."""
+        yield from list(self._snapshots)
+
+    def save_notice(
+        self, event_path: str, observer_path: str, method_name: str
+    ) -> None:
+        """Part of the Storage API, record an notice (event and observer)."""
+        self._notices.append((event_path, observer_path, method_name))
+
+    def drop_notice(
+        self, event_path: str, observer_path: str, method_name: str
+    ) -> None:
+        """Part of the Storage API, remove a notice that was previously recorded."""
+        notice = (event_path, observer_path, method_name)
+        self._notices = [n for n in self._notices if n != notice]
+
+    def notices(
+        self, event_path: Optional[str] = None
+    ) -> Iterator[Tuple[str, str, str]]:
+        """Part of the Storage API, return all notices that begin with event_path."""
+        # iterate over a copy: the framework drops notices while reemitting them
+        for notice in list(self._notices):
+            if not event_path or notice[0] == event_path:
+                yield notice
+
+
+_STORAGES = {"memory": _MemoryStorage}
+
+
+def _use_storage(harness: Harness, storage: str):
+    """Swap the storage of a harness that hasn't begun yet."""
+    if storage == "default":
+        return
+    try:
+        new_storage = _STORAGES[storage]()
+    except KeyError:
+        raise ValueError(
+            "unknown storage {!r}; should be one of {}".format(
+                storage, ["default", *_STORAGES]
+            )
+        ) from None
+    harness._storage.close()
+    harness._storage = harness.framework._storage = new_storage  # type: ignore
+
+
+# backend attributes that are not plain state, and are not reset by HarnessPool
+_BACKEND_RESOURCES = frozenset(("_harness_tmp_dir", "_resource_dir", "_meta"))
+
+
+class _HarnessSnapshot:
+    """State of a begun harness, which it can be reset to."""
+
+    def __init__(self, harness: Harness):
+        self.harness = harness
+        backend = harness._backend
+        framework = harness.framework
+
+        excluded = _BACKEND_RESOURCES | {
+            "_config",
+            "_pebble_clients",
+            "_pebble_clients_can_connect",
+        }
+        self.backend = copy.deepcopy(
+            {key: value for key, value in vars(backend).items() if key not in excluded}
+        )
+        # the testing config is a dict that refuses item assignment, which
+        # deepcopy relies on: copy its items and attributes (spec, defaults...)
+        config = backend._config
+        self.config = (type(config), dict(config), copy.deepcopy(vars(config)))
+        self.relation_id_counter = harness._relation_id_counter
+        self.hooks_enabled = harness._hooks_enabled
+        self.charm = dict(vars(harness.charm))
+
+        self.observers = list(framework._observers)
+        self.observer = dict(framework._observer)
+        self.objects = dict(framework._objects)
+        self.type_registry = dict(framework._type_registry)
+        self.type_known = set(framework._type_known)
+        self.stored = {
+            path: copy.deepcopy(obj._cache)
+            for path, obj in self.objects.items()
+            if isinstance(obj, StoredStateData)
+        }
+        self.storage = self._snapshot_storage(harness._storage)
+
+    @staticmethod
+    def _snapshot_storage(storage):
+        if isinstance(storage, SQLiteStorage):
+            db = sqlite3.connect(":memory:")
+            storage._db.backup(db)
+            return db
+        return copy.deepcopy(vars(storage))
+
+    def restore(self):
+        """Reset the harness to the state it was in when the snapshot was taken."""
+        harness = self.harness
+        backend = harness._backend
+        framework = harness.framework
+
+        for key in list(vars(backend)):
+            if key not in _BACKEND_RESOURCES:
+                delattr(backend, key)
+        vars(backend).update(copy.deepcopy(self.backend))
+        backend._pebble_clients = {}
+        backend._pebble_clients_can_connect = {}
+        config_type, config_items, config_attrs = self.config
+        config = dict.__new__(config_type)
+        dict.update(config, config_items)
+        vars(config).update(copy.deepcopy(config_attrs))
+        backend._config = config
+        harness._relation_id_counter = self.relation_id_counter
+        harness._hooks_enabled = self.hooks_enabled
+
+        storage = harness._storage
+        if isinstance(storage, SQLiteStorage):
+            self.storage.backup(storage._db)
+        else:
+            storage.__dict__.update(copy.deepcopy(self.storage))
+
+        framework._observers[:] = self.observers
+        framework._observer.clear()
+        framework._observer.update(self.observer)
+        framework._objects.clear()
+        framework._objects.update(self.objects)
+        framework._type_registry = dict(self.type_registry)
+        framework._type_known = set(self.type_known)
+        for path, cache in self.stored.items():
+            stored = typing.cast(StoredStateData, self.objects[path])
+            stored._cache = copy.deepcopy(cache)
+            stored.dirty = False
+
+        # the model caches relations, bindings, statuses...: start afresh
+        harness._model = framework.model = Model(harness._meta, backend)
+
+        charm = harness.charm
+        vars(charm).clear()
+        vars(charm).update(self.charm)
+
+
+def _build_harness(
+    charm: Type[CharmBase],
+    spec_cache: Optional[CharmSpecCache],
+    storage: str = "default",
+    **kwargs
+) -> Harness:
+    if spec_cache is None:
+        harness = Harness(charm, **kwargs)
+    else:
+        harness = spec_cache.harness(charm, **kwargs)
+    _use_storage(harness, storage)
+    return harness
+
+
+class HarnessPool:
+    """Pool of begun harnesses, reused across HarnessCtx runs.
+
+    Building a harness (parsing metadata, setting up the framework and its
+    storage, instantiating the charm) only happens the first time a harness
+    for a given charm class (and metadata) is needed. Afterwards, released
+    harnesses are reset to the state they were in right after `begin()`,
+    and handed out again.
+
+    Note that a released harness remains valid (e.g. for inspection, after
+    the HarnessCtx it was used by exits) until it is acquired again. Also
+    note that charm instance attributes are reset, but objects they point
+    to that were mutated in place are not.
+
+    Example usage:
+    >>> pool = HarnessPool()
+    >>> for event in ("start", "update-status"):
+    >>>     with HarnessCtx(MyCharm, event, pool=pool) as h:
+    >>>         ...
+    """
+
+    def __init__(
+        self, spec_cache: Optional[CharmSpecCache] = None, storage: str = "default"
+    ):
+        self.spec_cache = spec_cache
+        self.storage = storage
+        self._lock = threading.Lock()
+        # {(charm class, meta, actions, config): [snapshot, ...]}
+        self._free: Dict[tuple, List[_HarnessSnapshot]] = {}
+        self._leased: Dict[Harness, Tuple[tuple, _HarnessSnapshot]] = {}
+
+    def acquire(
+        self,
+        charm: Type[CharmBase],
+        meta: Optional[str] = None,
+        actions: Optional[str] = None,
+        config: Optional[str] = None,
+    ) -> Harness:
+        """Get a begun harness for `charm`, in a clean state."""
+        key = (charm, meta, actions, config)
+        with self._lock:
+            free = self._free.get(key)
+            snapshot = free.pop() if free else None
+
+        if snapshot is None:
+            harness = _build_harness(
+                charm,
+                self.spec_cache,
+                self.storage,
+                meta=meta,
+                actions=actions,
+                config=config,
+            )
+            harness.begin()
+            snapshot = _HarnessSnapshot(harness)
+        else:
+            snapshot.restore()
+
+        with self._lock:
+            self._leased[snapshot.harness] = (key, snapshot)
+        return snapshot.harness
+
+    def release(self, harness: Harness):
+        """Give back a harness obtained from `acquire`."""
+        with self._lock:
+            key, snapshot = self._leased.pop(harness)
+            self._free.setdefault(key, []).append(snapshot)
+
 
 class HarnessCtx:
     """Harness-based context for emitting a single event.
@@ -59,6 +478,22 @@ class HarnessCtx:
     >>>     assert event.handle.kind == "update_status"
     >>>
     >>> assert h.harness.charm.event.handle.kind == "commit"
+
+    Pass a HarnessPool as `pool` to reuse harnesses across runs, and a
+    CharmSpecCache as `spec_cache` to only parse the charm's yaml once.
+    Pass an already begun `harness` to emit the event on it instead.
+    Pass `storage="memory"` to have the framework store snapshots and
+    deferred events in a dict instead of an (in-memory) sqlite database.
+
+    The harness is only built when it's first needed, and if the body of the
+    context raises, the event (if not emitted yet) and commit are skipped.
+
+    Pass `settle` to re-emit deferred events (at most `settle` rounds) before
+    committing; see `Emitter.settle`. The stats end up in `deferral_stats`:
+    >>> ctx = HarnessCtx(MyCharm, "update-status", settle=10)
+    >>> with ctx:
+    >>>     pass
+    >>> assert ctx.deferral_stats.converged, ctx.deferral_stats.reemissions
     """
 
     def __init__(
@@ -67,39 +502,405 @@ class HarnessCtx:
         event_name: str,
         emitter: Callable[[CharmBase, Harness], _HasOn] = _DefaultEmitter,
         *args,
+        pool: Optional[HarnessPool] = None,
+        spec_cache: Optional[CharmSpecCache] = None,
+        harness: Optional[Harness] = None,
+        storage: str = "default",
+        settle: Optional[int] = None,
         **kwargs
     ):
         self.charm_cls = charm
+        self.pool = pool
+        self.spec_cache = spec_cache
+        self.storage = storage
+        self.settle = settle
+        self.deferral_stats: Optional[DeferralStats] = None
+        self._begun = harness
         self.emitter = emitter
         self.event_name = event_name.replace("-", "_")
         self.event_args = args
         self.event_kwargs = kwargs
 
-    def __enter__(self):
-        self._harness = harness = Harness(self.charm_cls)
+    def _harness(self) -> Harness:
+        if self._begun is not None:
+            return self._begun
+        if self.pool:
+            return self.pool.acquire(self.charm_cls)
+        harness = _build_harness(self.charm_cls, self.spec_cache, self.storage)
         harness.begin()
+        return harness
 
-        emitter = self.emitter(harness.charm, harness)
-        events = getattr(emitter, "on")
+    def _emit(self, harness: Harness) -> BoundEvent:
+        events = self.emitter(harness.charm, harness).on
         event_source: BoundEvent = getattr(events, self.event_name)
 
-        def _emit() -> BoundEvent:
-            # we don't call event_source.emit()
-            # because we want to grab the event
-            framework = event_source.emitter.framework
-            key = framework._next_event_key()
-            handle = Handle(event_source.emitter, event_source.event_kind, key)
-            event = event_source.event_type(
-                handle, *self.event_args, **self.event_kwargs
-            )
-            event.framework = framework
-            framework._emit(event)  # type: ignore
-            return typing.cast(BoundEvent, event)
+        # we don't call event_source.emit()
+        # because we want to grab the event
+        framework = events.framework
+        key = framework._next_event_key()
+        handle = Handle(events, event_source.event_kind, key)
+        event = event_source.event_type(handle, *self.event_args, **self.event_kwargs)
+        event.framework = framework
+        framework._emit(event)  # type: ignore
+        return typing.cast(BoundEvent, event)
 
-        self._emitter = bound_ctx = Emitter(harness, _emit)
+    def __enter__(self):
+        self._emitter = bound_ctx = Emitter(self._harness, self._emit)
         return bound_ctx
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if not self._emitter.emitted:
-            self._emitter.emit()
-        self._harness.framework.on.commit.emit()  # type: ignore
+        if exc_type is None:
+            if not self._emitter.emitted:
+                self._emitter.emit()
+            if self.settle is not None:
+                self.deferral_stats = self._emitter.settle(self.settle)
+            self._emitter.harness.framework.on.commit.emit()  # type: ignore
+        harness = self._emitter._harness
+        if self.pool and harness is not None and harness is not self._begun:
+            self.pool.release(harness)
+
+
+class AsyncEmitter:
+    """Event emitter for AsyncHarnessCtx."""
+
+    def __init__(
+        self,
+        emitter: Emitter,
+        loop: asyncio.AbstractEventLoop,
+        executor: Optional[Executor],
+    ):
+        self._emitter = emitter
+        self._loop = loop
+        self._executor = executor
+
+    @property
+    def harness(self) -> Harness:
+        """The harness the event is emitted on."""
+        return self._emitter.harness
+
+    @property
+    def event(self):
+        """The emitted event, if any."""
+        return self._emitter.event
+
+    @property
+    def emitted(self):
+        """Has the event been emitted already?"""  # noqa
+        return self._emitter.emitted
+
+    async def emit(self):
+        """Emit the event, in the executor.
+
+        Will get called automatically when AsyncHarnessCtx exits if you didn't call it already.
+        """
+        return await self._loop.run_in_executor(self._executor, self._emitter.emit)
+
+
+class AsyncHarnessCtx:
+    """Asynchronous HarnessCtx.
+
+    The harness is built, and the event emitted, in `executor` (by default,
+    the event loop's default executor), so many of them can run at once
+    without blocking the event loop.
+
+    As the harness is used from different threads, it must use in-memory
+    storage: sqlite connections can't be shared across threads. So `storage`
+    can only be "memory", and a `pool` or `harness`, if given, must use
+    in-memory storage too (e.g. `HarnessPool(storage="memory")`); a
+    ValueError is raised otherwise. All other arguments are as for HarnessCtx.
+
+    Example usage:
+    >>> async with AsyncHarnessCtx(MyCharm, "update-status") as h:
+    >>>     event = await h.emit()
+    >>>     assert event.handle.kind == "update_status"
+    """
+
+    def __init__(
+        self,
+        charm: Type[CharmBase],
+        event_name: str,
+        emitter: Callable[[CharmBase, Harness], _HasOn] = _DefaultEmitter,
+        *args,
+        executor: Optional[Executor] = None,
+        pool: Optional[HarnessPool] = None,
+        spec_cache: Optional[CharmSpecCache] = None,
+        harness: Optional[Harness] = None,
+        storage: str = "memory",
+        settle: Optional[int] = None,
+        **kwargs
+    ):
+        if storage != "memory":
+            raise ValueError("AsyncHarnessCtx needs in-memory storage")
+        if pool is not None and pool.storage != "memory":
+            raise ValueError(
+                "AsyncHarnessCtx needs a pool with in-memory storage; "
+                'use HarnessPool(storage="memory")'
+            )
+        if harness is not None and not isinstance(harness._storage, _MemoryStorage):
+            raise ValueError("AsyncHarnessCtx needs a harness with in-memory storage")
+
+        self.executor = executor
+        self._ctx = HarnessCtx(
+            charm,
+            event_name,
+            emitter,
+            *args,
+            pool=pool,
+            spec_cache=spec_cache,
+            harness=harness,
+            storage=storage,
+            settle=settle,
+            **kwargs,
+        )
+
+    @property
+    def deferral_stats(self) -> Optional[DeferralStats]:
+        """Deferred events stats, if `settle` was given; see HarnessCtx."""
+        return self._ctx.deferral_stats
+
+    def _enter(self) -> Emitter:
+        emitter = self._ctx.__enter__()
+        emitter.harness  # build it here, not in the event loop's thread
+        return emitter
+
+    async def __aenter__(self) -> AsyncEmitter:
+        loop = asyncio.get_running_loop()
+        emitter = await loop.run_in_executor(self.executor, self._enter)
+        return AsyncEmitter(emitter, loop, self.executor)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.executor, self._ctx.__exit__, exc_type, exc_val, exc_tb
+        )
+
+
+async def gather_contexts(
+    *contexts: AsyncHarnessCtx, limit: int = 8, return_exceptions: bool = False
+) -> List[Any]:
+    """Emit the event of each context, running at most `limit` of them at once.
+
+    Returns the AsyncEmitters, in the same order as the contexts, with the
+    event emitted and committed. With `return_exceptions`, the exceptions
+    raised by a context are returned in its place instead of being raised.
+
+    Example usage:
+    >>> emitters = await gather_contexts(
+    >>>     *(AsyncHarnessCtx(MyCharm, event) for event in ("start", "update-status")),
+    >>>     limit=4,
+    >>> )
+    >>> assert emitters[0].event.handle.kind == "start"
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def _run(ctx: AsyncHarnessCtx) -> AsyncEmitter:
+        async with semaphore:
+            async with ctx as emitter:
+                await emitter.emit()
+            return emitter
+
+    return await asyncio.gather(
+        *(_run(ctx) for ctx in contexts), return_exceptions=return_exceptions
+    )
+
+
+class Scenario(NamedTuple):
+    """A case for `run_scenarios`.
+
+    `setup`, if given, is called with the begun harness before `event_name` is
+    emitted with `args` and `kwargs`. Like the charm class, it has to be
+    picklable (i.e. defined at module level) to be sent to the workers.
+    """
+
+    event_name: str
+    args: tuple = ()
+    kwargs: Optional[Dict[str, Any]] = None
+    setup: Optional[Callable[[Harness], None]] = None
+
+
+class ScenarioResult(NamedTuple):
+    """Outcome of a Scenario.
+
+    `events` holds a (kind, handle path, snapshot) triple for each event
+    emitted on the framework, starting with the scenario's own event.
+    `error` is the formatted traceback if the scenario raised.
+    """
+
+    scenario: Scenario
+    events: List[Tuple[str, str, Dict[str, Any]]]
+    unit_status: Optional[StatusBase]
+    app_status: Optional[StatusBase]
+    error: Optional[str] = None
+
+
+# one pool per worker (process or thread), so each worker begins each charm
+# only once, and harnesses never cross threads
+_WORKER = threading.local()
+
+
+def _status(harness: Harness, is_app: bool) -> StatusBase:
+    # read from the backend: model.app.status can't be read by non-leaders
+    raw = harness._backend.status_get(is_app=is_app)
+    return StatusBase.from_name(raw["status"], raw["message"])
+
+
+def _run_scenario(
+    charm: Type[CharmBase], scenario: Scenario, harness: Optional[Harness] = None
+) -> ScenarioResult:
+    pool = None
+    if harness is None:
+        pool = getattr(_WORKER, "pool", None)
+        if pool is None:
+            pool = _WORKER.pool = HarnessPool(storage="memory")
+
+    events: List[Tuple[str, str, Dict[str, Any]]] = []
+    unit_status = app_status = None
+    try:
+        with HarnessCtx(
+            charm,
+            scenario.event_name,
+            *scenario.args,
+            pool=pool,
+            harness=harness,
+            **(scenario.kwargs or {}),
+        ) as ctx:
+            harness = ctx.harness
+            if scenario.setup:
+                scenario.setup(harness)
+
+            framework = harness.framework
+            real_emit = framework._emit
+            patched = "_emit" in vars(framework)
+
+            def _emit(event):
+                events.append((event.handle.kind, event.handle.path, event.snapshot()))
+                real_emit(event)
+
+            framework._emit = _emit
+            try:
+                ctx.emit()
+            finally:
+                if patched:
+                    framework._emit = real_emit
+                else:
+                    del framework._emit
+
+            unit_status = _status(harness, is_app=False)
+            app_status = _status(harness, is_app=True)
+    except Exception:
+        return ScenarioResult(
+            scenario, events, unit_status, app_status, traceback.format_exc()
+        )
+    return ScenarioResult(scenario, events, unit_status, app_status)
+
+
+def run_scenarios(
+    charm: Type[CharmBase],
+    scenarios: Iterable[Scenario],
+    max_workers: Optional[int] = None,
+    executor: Optional[Executor] = None,
+) -> List[ScenarioResult]:
+    """Run each scenario in its own HarnessCtx, across a pool of processes.
+
+    Results are returned in the same order as the scenarios.
+    Pass an `executor` to use your own instead of a ProcessPoolExecutor with
+    `max_workers` workers.
+
+    Example usage:
+    >>> def set_config(harness):
+    >>>     harness.update_config({"port": 80})
+    >>>
+    >>> results = run_scenarios(MyCharm, [
+    >>>     Scenario("start"),
+    >>>     Scenario("config-changed", setup=set_config),
+    >>> ])
+    >>> assert all(result.error is None for result in results)
+    """
+    scenarios = list(scenarios)
+    if executor is not None:
+        return list(executor.map(_run_scenario, repeat(charm), scenarios))
+    with ProcessPoolExecutor(max_workers) as pool:
+        return list(pool.map(_run_scenario, repeat(charm), scenarios))
+
+
+def fork_scenarios(
+    charm: Type[CharmBase],
+    scenarios: Iterable[Scenario],
+    setup: Optional[Callable[[Harness], None]] = None,
+    max_workers: Optional[int] = None,
+    spec_cache: Optional[CharmSpecCache] = None,
+    meta: Optional[str] = None,
+    actions: Optional[str] = None,
+    config: Optional[str] = None,
+    storage: str = "memory",
+) -> List[ScenarioResult]:
+    """Prepare a harness once, then run each scenario in a forked copy of it.
+
+    `setup` is called once on the harness, begun with `meta`, `actions` and
+    `config`; each scenario then runs in a child process which inherits the
+    prepared harness (copy-on-write), so scenarios are isolated from each
+    other without rebuilding the state.
+    At most `max_workers` (by default, one per cpu) children run at a time.
+    Results are returned in the same order as the scenarios.
+
+    Unlike `run_scenarios`, nothing but the results is pickled, so the charm
+    and the setup callables can be defined anywhere. Only works where
+    `os.fork` is available. The harness uses in-memory `storage` by default,
+    as sqlite connections should not be used across a fork.
+
+    Example usage:
+    >>> def add_relations(harness):
+    >>>     for _ in range(50):
+    >>>         harness.add_relation("db", "remote")
+    >>>
+    >>> results = fork_scenarios(MyCharm, [
+    >>>     Scenario("update-status"),
+    >>>     Scenario("upgrade-charm"),
+    >>> ], setup=add_relations)
+    """
+    scenarios = list(scenarios)
+    harness = _build_harness(
+        charm, spec_cache, storage, meta=meta, actions=actions, config=config
+    )
+    harness.begin()
+    if setup:
+        setup(harness)
+
+    max_workers = max_workers or os.cpu_count() or 1
+    results: List[ScenarioResult] = []
+    # (scenario, child pid, read end of the pipe)
+    running: Deque[Tuple[Scenario, int, int]] = deque()
+
+    def _collect():
+        scenario, pid, read = running.popleft()
+        with os.fdopen(read, "rb") as pipe:
+            data = pipe.read()
+        _, status = os.waitpid(pid, 0)
+        if data:
+            results.append(pickle.loads(data)._replace(scenario=scenario))
+        else:
+            error = "child process died with wait status {}".format(status)
+            results.append(ScenarioResult(scenario, [], None, None, error))
+
+    try:
+        for scenario in scenarios:
+            if len(running) >= max_workers:
+                _collect()
+            read, write = os.pipe()
+            pid = os.fork()
+            if pid == 0:  # child
+                try:
+                    os.close(read)
+                    result = _run_scenario(charm, scenario, harness=harness)
+                    # the parent has the scenario already, and it might not pickle
+                    data = pickle.dumps(result._replace(scenario=None))
+                    with os.fdopen(write, "wb") as pipe:
+                        pipe.write(data)
+                finally:
+                    os._exit(0)
+            os.close(write)
+            running.append((scenario, pid, read))
+    finally:
+        while running:
+            _collect()
+    return results
@@ -0,0 +1,56 @@
+"""Compare the default (sqlite) framework storage with storage="memory".
+
+Run with `python libs/harness_ctx/tests/benchmark_storage.py [runs] [deferrals]`.
+"""
+import sys
+import typing
+from pathlib import Path
+from timeit import timeit
+
+from ops.charm import CharmBase
+from ops.framework import Framework, StoredState
+
+lib_root = Path(__file__).parent.parent
+sys.path.append(str(lib_root))
+
+from harness_ctx import HarnessCtx  # noqa: E402
+
+
+class DeferringCharm(CharmBase):
+    """Charm that defers update-status a bunch of times."""
+
+    _stored = StoredState()
+
+    def __init__(self, framework: Framework, key: typing.Optional = None):
+        super().__init__(framework, key)
+        self._stored.set_default(deferrals=0)
+        self.framework.observe(self.on.update_status, self._on_update_status)
+
+    def _on_update_status(self, event):
+        if self._stored.deferrals:
+            self._stored.deferrals -= 1
+            event.defer()
+
+
+def run(storage: str, deferrals: int):
+    with HarnessCtx(DeferringCharm, "update-status", storage=storage) as h:
+        h.harness.charm._stored.deferrals = deferrals
+        h.emit()
+        for _ in range(deferrals):
+            h.harness.framework.reemit()
+
+
+def main(runs: int = 200, deferrals: int = 20):
+    results = {}
+    for storage in ("default", "memory"):
+        results[storage] = timeit(lambda: run(storage, deferrals), number=runs)
+        print(
+            "{:<8} {:.3f}s ({:.2f}ms/run)".format(
+                storage, results[storage], results[storage] / runs * 1000
+            )
+        )
+    print("speedup: {:.2f}x".format(results["default"] / results["memory"]))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
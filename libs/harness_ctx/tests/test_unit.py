@@ -1,15 +1,30 @@
+import asyncio
+import os
 import sys
+import threading
+import time
 import typing
 from pathlib import Path
 
 import pytest as pytest
 from ops.charm import CharmBase
-from ops.framework import Framework
+from ops.framework import Framework, StoredState
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
+from ops.testing import Harness
 
 lib_root = Path(__file__).parent.parent
 sys.path.append(str(lib_root))
 
-from harness_ctx import HarnessCtx
+from harness_ctx import (
+    AsyncHarnessCtx,
+    CharmSpecCache,
+    HarnessCtx,
+    HarnessPool,
+    Scenario,
+    fork_scenarios,
+    gather_contexts,
+    run_scenarios,
+)
 
 
 @pytest.fixture
@@ -31,3 +46,400 @@ def test_emit(charm_cls):
         event = h.emit()
         assert event.handle.kind == "update_status"
     assert h.harness.charm.event.handle.kind == "commit"
+
+
+def test_pool():
+    class MyCharm(CharmBase):
+        _stored = StoredState()
+
+        def __init__(self, framework: Framework, key: typing.Optional = None):
+            super().__init__(framework, key)
+            self._stored.set_default(count=0)
+            self.framework.observe(self.on.update_status, self._on_update_status)
+
+        def _on_update_status(self, _):
+            self._stored.count += 1
+            self.unit.status = ActiveStatus(str(self._stored.count))
+            self.seen = True
+
+    pool = HarnessPool()
+    harnesses = []
+    for _ in range(3):
+        with HarnessCtx(MyCharm, "update-status", pool=pool) as h:
+            harness = h.harness
+            assert not hasattr(harness.charm, "seen")
+            assert harness.model.unit.status == MaintenanceStatus("")
+        harnesses.append(harness)
+        assert harness.charm.seen
+        assert harness.charm._stored.count == 1
+        assert harness.model.unit.status == ActiveStatus("1")
+
+    # a single harness was built
+    assert harnesses[0] is harnesses[1] is harnesses[2]
+
+
+@pytest.mark.parametrize("storage", ("default", "memory"))
+def test_pool_resets_config_leader_relations(storage):
+    class MyCharm(CharmBase):
+        pass
+
+    meta = "name: foo\nrequires:\n  db:\n    interface: db\n"
+    config = "options:\n  bar:\n    type: int\n    default: 42\n"
+    pool = HarnessPool(storage=storage)
+
+    harness = pool.acquire(MyCharm, meta, None, config)
+    assert harness.model.config["bar"] == 42
+    harness.update_config({"bar": 1})
+    harness.set_leader(True)
+    harness.add_relation("db", "remote")
+    assert harness.model.config["bar"] == 1
+    pool.release(harness)
+
+    again = pool.acquire(MyCharm, meta, None, config)
+    assert again is harness
+    assert again.model.config["bar"] == 42
+    assert not again.model.unit.is_leader()
+    assert not again.model.relations["db"]
+    # and the harness still works as usual
+    again.update_config({"bar": 2})
+    assert again.model.config["bar"] == 2
+    assert again.add_relation("db", "remote") == 0
+    pool.release(again)
+
+
+def test_spec_cache(tmp_path):
+    class MyCharm(CharmBase):
+        pass
+
+    meta = "name: foo\nrequires:\n  db:\n    interface: db\n"
+    config = "options:\n  bar:\n    type: int\n    default: 42\n"
+    specs = CharmSpecCache()
+    h1 = specs.harness(MyCharm, meta=meta, config=config)
+    h2 = specs.harness(MyCharm, meta=meta, config=config)
+    assert h1._meta is h2._meta
+    assert len(specs._meta) == len(specs._config) == 1
+
+    h2.begin()
+    assert h2.charm.meta.name == "foo"
+    assert h2.model.config["bar"] == 42
+    h2.update_config({"bar": 1})
+    # the cached defaults are left untouched
+    assert specs.harness(MyCharm, meta=meta, config=config).model.config["bar"] == 42
+
+    specs.harness(MyCharm, meta="name: baz\n", config=config)
+    assert len(specs._meta) == 2
+
+    with HarnessCtx(MyCharm, "start", spec_cache=specs) as h:
+        h.emit()
+    specs.clear()
+    assert not specs._meta and not specs._config
+
+
+class ScenarioCharm(CharmBase):
+    port = None
+    fail = False
+
+    def __init__(self, framework: Framework, key: typing.Optional = None):
+        super().__init__(framework, key)
+        self.framework.observe(self.on.update_status, self._on_update_status)
+
+    def _on_update_status(self, _):
+        if self.fail:
+            raise ValueError("boom")
+        self.unit.status = ActiveStatus(str(self.port))
+
+
+def _set_port(harness):
+    harness.charm.port = 80
+
+
+def _set_fail(harness):
+    harness.charm.fail = True
+
+
+def test_run_scenarios():
+    scenarios = [
+        Scenario("start"),
+        Scenario("update-status", setup=_set_port),
+        Scenario("update-status", setup=_set_fail),
+        Scenario("update-status"),
+    ]
+    start, port, fail, no_port = run_scenarios(ScenarioCharm, scenarios, max_workers=2)
+
+    assert start.error is None
+    assert [kind for kind, _, _ in start.events] == ["start"]
+    assert start.unit_status == MaintenanceStatus("")
+
+    assert port.unit_status == ActiveStatus("80")
+    assert "ValueError: boom" in fail.error
+    # each scenario starts from a clean harness
+    assert no_port.error is None
+    assert no_port.unit_status == ActiveStatus("None")
+
+
+_CONFIG_CHARM = """
+from ops.charm import CharmBase
+from ops.model import ActiveStatus, BlockedStatus
+
+
+class ConfigCharm(CharmBase):
+    def __init__(self, framework, key=None):
+        super().__init__(framework, key)
+        self.framework.observe(self.on.config_changed, self._on_config_changed)
+
+    def _on_config_changed(self, _):
+        if not self.unit.is_leader():
+            self.unit.status = BlockedStatus("not leader")
+        else:
+            self.unit.status = ActiveStatus(str(self.config["port"]))
+"""
+
+
+def _configure(harness):
+    harness.set_leader(True)
+    harness.update_config({"port": 8080})
+
+
+def test_run_scenarios_config(tmp_path, monkeypatch):
+    # a charm with its own metadata.yaml and config.yaml, like a real one
+    (tmp_path / "metadata.yaml").write_text("name: config-charm\n")
+    (tmp_path / "config.yaml").write_text(
+        "options:\n  port:\n    type: int\n    default: 80\n"
+    )
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "config_charm.py").write_text(_CONFIG_CHARM)
+    monkeypatch.syspath_prepend(str(tmp_path / "src"))
+    from config_charm import ConfigCharm
+
+    scenarios = [
+        Scenario("start"),
+        Scenario("config-changed"),
+        Scenario("config-changed", setup=_configure),
+        Scenario("config-changed"),
+    ]
+    # a single worker, so that its pooled harness is reused by all scenarios
+    start, default, configured, reset = run_scenarios(
+        ConfigCharm, scenarios, max_workers=1
+    )
+    assert [result.error for result in (start, default, configured, reset)] == [
+        None
+    ] * 4
+    assert default.unit_status == BlockedStatus("not leader")
+    assert configured.unit_status == ActiveStatus("8080")
+    # config and leadership were reset
+    assert reset.unit_status == BlockedStatus("not leader")
+
+
+def test_run_scenarios_threads():
+    from concurrent.futures import ThreadPoolExecutor
+
+    scenarios = [Scenario("update-status", setup=_set_port)] * 8
+    with ThreadPoolExecutor(4) as executor:
+        results = run_scenarios(ScenarioCharm, scenarios, executor=executor)
+    assert [result.error for result in results] == [None] * 8
+    assert all(result.unit_status == ActiveStatus("80") for result in results)
+
+
+def test_fork_scenarios():
+    class MyCharm(CharmBase):
+        def __init__(self, framework: Framework, key: typing.Optional = None):
+            super().__init__(framework, key)
+            self.framework.observe(self.on.update_status, self._on_update_status)
+
+        def _on_update_status(self, _):
+            relations = self.model.relations["db"]
+            self.unit.status = ActiveStatus(str(len(relations)))
+
+    def add_relations(harness):
+        for _ in range(3):
+            harness.add_relation("db", "remote")
+
+    scenarios = [
+        Scenario("update-status"),
+        # these don't need to be picklable
+        Scenario("update-status", setup=lambda h: h.add_relation("db", "remote")),
+        Scenario("update-status", setup=lambda h: os._exit(1)),
+        Scenario("update-status"),
+    ]
+    meta = "name: foo\nrequires:\n  db:\n    interface: db\n"
+    three, four, died, isolated = fork_scenarios(
+        MyCharm,
+        scenarios,
+        setup=add_relations,
+        max_workers=2,
+        spec_cache=CharmSpecCache(),
+        meta=meta,
+    )
+
+    assert three.error is None
+    assert three.scenario is scenarios[0]
+    assert [kind for kind, _, _ in three.events] == ["update_status"]
+    assert three.unit_status == ActiveStatus("3")
+    assert four.unit_status == ActiveStatus("4")
+    assert "child process died" in died.error
+    assert isolated.unit_status == ActiveStatus("3")
+
+
+@pytest.mark.parametrize("storage", ("default", "memory"))
+def test_storage(storage):
+    class MyCharm(CharmBase):
+        _stored = StoredState()
+
+        def __init__(self, framework: Framework, key: typing.Optional = None):
+            super().__init__(framework, key)
+            self._stored.set_default(runs=0)
+            self.framework.observe(self.on.update_status, self._on_update_status)
+
+        def _on_update_status(self, event):
+            self._stored.runs += 1
+            if self._stored.runs < 3:
+                event.defer()
+
+    pool = HarnessPool(storage=storage)
+    for _ in range(2):
+        with HarnessCtx(MyCharm, "update-status", pool=pool) as h:
+            h.emit()
+            framework = h.harness.framework
+            assert len(list(framework._storage.notices())) == 1
+            framework.reemit()
+            framework.reemit()
+            assert not list(framework._storage.notices())
+            assert h.harness.charm._stored.runs == 3
+        # committed on exit
+        stored = framework._storage.load_snapshot("MyCharm/StoredStateData[_stored]")
+        assert stored["runs"] == 3
+
+
+@pytest.mark.parametrize("storage", ("default", "memory"))
+def test_storage_uncommitted(storage):
+    class MyCharm(CharmBase):
+        _stored = StoredState()
+
+        def __init__(self, framework: Framework, key: typing.Optional = None):
+            super().__init__(framework, key)
+            self._stored.set_default(n=0)
+
+    with HarnessCtx(MyCharm, "update-status", storage=storage) as h:
+        framework = h.harness.framework
+        framework.commit()
+        h.harness.charm._stored.n = 5
+        stored = framework._storage.load_snapshot("MyCharm/StoredStateData[_stored]")
+        assert stored == {"n": 0}
+
+
+def test_storage_unknown(charm_cls):
+    with pytest.raises(ValueError):
+        with HarnessCtx(charm_cls, "update-status", storage="redis"):
+            pass
+
+
+def test_async_ctx():
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    class MyCharm(CharmBase):
+        def __init__(self, framework: Framework, key: typing.Optional = None):
+            super().__init__(framework, key)
+            self.framework.observe(self.on.update_status, self._on_update_status)
+            self.framework.observe(self.on.remove, self._on_remove)
+
+        def _on_update_status(self, _):
+            with lock:
+                running.append(self)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(self)
+
+        def _on_remove(self, _):
+            raise ValueError("boom")
+
+    async def main():
+        async with AsyncHarnessCtx(MyCharm, "update-status") as h:
+            event = await h.emit()
+            assert h.emitted
+            assert event.handle.kind == "update_status"
+
+        contexts = [AsyncHarnessCtx(MyCharm, "update-status") for _ in range(6)]
+        contexts.append(AsyncHarnessCtx(MyCharm, "remove"))
+        return await gather_contexts(*contexts, limit=2, return_exceptions=True)
+
+    *emitters, error = asyncio.run(main())
+    assert all(e.event.handle.kind == "update_status" for e in emitters)
+    assert isinstance(error, ValueError)
+    assert max(peak) <= 2
+
+
+def test_async_ctx_storage(charm_cls):
+    with pytest.raises(ValueError):
+        AsyncHarnessCtx(charm_cls, "update-status", storage="default")
+    with pytest.raises(ValueError):
+        AsyncHarnessCtx(charm_cls, "update-status", pool=HarnessPool())
+    harness = Harness(charm_cls)
+    with pytest.raises(ValueError):
+        AsyncHarnessCtx(charm_cls, "update-status", harness=harness)
+
+    pool = HarnessPool(storage="memory")
+    contexts = [
+        AsyncHarnessCtx(charm_cls, "update-status", pool=pool) for _ in range(16)
+    ]
+    emitters = asyncio.run(gather_contexts(*contexts, limit=8))
+    assert all(e.event.handle.kind == "update_status" for e in emitters)
+
+
+def test_lazy(charm_cls):
+    built = []
+
+    class Pool(HarnessPool):
+        def acquire(self, *args, **kwargs):
+            built.append(True)
+            return super().acquire(*args, **kwargs)
+
+    pool = Pool()
+    with pytest.raises(RuntimeError):
+        with HarnessCtx(charm_cls, "update-status", pool=pool):
+            raise RuntimeError("bail out")
+    assert not built
+
+    with HarnessCtx(charm_cls, "update-status", pool=pool) as h:
+        assert not built
+        assert h.harness is h.harness
+        assert len(built) == 1
+    assert h.event.handle.kind == "update_status"
+    assert h.harness.charm.event.handle.kind == "commit"
+
+
+def test_settle():
+    class MyCharm(CharmBase):
+        _stored = StoredState()
+
+        def __init__(self, framework: Framework, key: typing.Optional = None):
+            super().__init__(framework, key)
+            self._stored.set_default(runs=0)
+            self.framework.observe(self.on.update_status, self._on_update_status)
+            self.framework.observe(self.on.start, self._on_start)
+
+        def _on_update_status(self, event):
+            self._stored.runs += 1
+            if self._stored.runs < 4:
+                event.defer()
+
+        def _on_start(self, event):
+            event.defer()
+
+    ctx = HarnessCtx(MyCharm, "update-status", settle=10)
+    with ctx as h:
+        pass
+    stats = ctx.deferral_stats
+    assert stats.converged
+    assert stats.iterations == 3
+    assert stats.reemissions == {"update_status": 3}
+    assert h.harness.charm._stored.runs == 4
+
+    with HarnessCtx(MyCharm, "start") as h:
+        h.emit()
+        stats = h.settle(limit=5)
+    assert not stats.converged
+    assert stats.pending == 1
+    assert stats.reemissions["start"] == stats.iterations == 5
@@ -1,13 +1,36 @@
 # Copyright 2022 Canonical Ltd.
 # See LICENSE file for licensing details.
+import ipaddress
+import json
 import logging
-from collections import defaultdict
+import threading
+from collections import deque
 from contextlib import contextmanager
-from copy import deepcopy
-from typing import Dict, List, Optional, TypedDict, Union
+from functools import lru_cache
+from pathlib import Path
+from time import perf_counter
+from types import MappingProxyType
+from typing import (
+    TYPE_CHECKING,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    TypedDict,
+    Union,
+)
 
 from ops.model import Relation
 
+if TYPE_CHECKING:
+    from ops.testing import Harness
+
 log = logging.getLogger("networking")
 
 
@@ -49,9 +72,249 @@ _Network = TypedDict(
     },
 )
 
+_IPAddress = Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
+_IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+# raw `network-get` dicts, or their compact form
+_AnyNetwork = Union[_Network, "FrozenNetwork"]
+# (endpoint_name, relation_id)
+_BindingKey = Tuple[str, Optional[int]]
+# what networks can be keyed by, when passing many of them at once
+_Binding = Union[str, Relation, _BindingKey]
+
+
+class CacheInfo(NamedTuple):
+    """`network_get` cache statistics of a NetworkRegistry."""
+
+    hits: int
+    misses: int
+    currsize: int
+
+
+class NetworkStats:
+    """Usage statistics of `network_get`, per endpoint.
+
+    For each endpoint, this tracks:
+        - `calls`: how many times `network_get` was called
+        - `fallbacks`: how many of those, for a specific relation, were served
+          by the default network of the endpoint
+        - `misses`: how many of those raised NetworkingError
+        - `time`: cumulative time spent in `network_get`, in seconds
+    """
+
+    def __init__(self):
+        # {endpoint_name: [calls, fallbacks, misses, time]}
+        self._endpoints = {}  # type: Dict[str, List[Union[int, float]]]
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        endpoint_name: str,
+        elapsed: float,
+        fallback: bool = False,
+        miss: bool = False,
+    ):
+        """Record a `network_get` call."""
+        with self._lock:
+            counters = self._endpoints.get(endpoint_name)
+            if counters is None:
+                counters = self._endpoints[endpoint_name] = [0, 0, 0, 0.0]
+            counters[0] += 1
+            counters[1] += fallback
+            counters[2] += miss
+            counters[3] += elapsed
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._endpoints.clear()
+
+    def as_dict(self) -> Dict[str, Dict[str, Union[int, float]]]:
+        """Export the statistics, busiest endpoints first."""
+        with self._lock:
+            endpoints = sorted(self._endpoints.items(), key=lambda item: -item[1][0])
+            return {
+                endpoint_name: dict(zip(_STATS_FIELDS, counters))
+                for endpoint_name, counters in endpoints
+            }
+
+    def to_json(self, path: Optional[Union[str, Path]] = None) -> str:
+        """Export the statistics as json; and write them to `path`, if given."""
+        dumped = json.dumps(self.as_dict(), indent=2)
+        if path:
+            Path(path).write_text(dumped)
+        return dumped
+
+
+_STATS_FIELDS = ("calls", "fallbacks", "misses", "time")
+
+
+class NetworkRegistry:
+    """Table of networks, keyed by endpoint name and relation id.
 
-def activate(juju_info_network: "_Network" = JUJU_INFO):
-    """Patches harness.backend.network_get and initializes the juju-info binding."""
+    There is one global registry, managed by `activate`/`deactivate`, plus
+    one per Harness for every Harness passed to `attach`.
+
+    The table is a stack of layers: `push` opens a new (empty) layer, which
+    receives all subsequent changes, and `pop` drops it, undoing them.
+    Lookups walk the stack from the top down.
+    """
+
+    def __init__(self, juju_info_network: Optional["_AnyNetwork"] = JUJU_INFO):
+        # [{(endpoint_name, relation_id): network}, ...];
+        # relation_id None is the default network for the endpoint,
+        # network None means the network was removed in that layer.
+        self._layers = [{}]  # type: List[Dict[_BindingKey, Optional[_AnyNetwork]]]
+        # {endpoint_name: {relation_id: network_get response}}
+        self._cache = {}  # type: Dict[str, Dict[Optional[int], _Network]]
+        self._hits = self._misses = 0
+        # see `collect_stats`
+        self.stats = None  # type: Optional[NetworkStats]
+        if juju_info_network:
+            self._set(("juju-info", None), juju_info_network)
+
+    def push(self):
+        """Open a new layer."""
+        self._layers.append({})
+
+    def pop(self):
+        """Drop the topmost layer, and all changes made since it was pushed."""
+        if len(self._layers) == 1:
+            raise NetworkingError("cannot pop the base layer")
+        for key in self._layers.pop():
+            self._invalidate(key)
+
+    def cache_info(self) -> "CacheInfo":
+        """Report `network_get` cache statistics."""
+        return CacheInfo(self._hits, self._misses, sum(map(len, self._cache.values())))
+
+    def cache_clear(self):
+        """Clear the `network_get` cache and its statistics."""
+        self._cache.clear()
+        self._hits = self._misses = 0
+
+    def _invalidate(self, key: _BindingKey):
+        endpoint_name, relation_id = key
+        if relation_id is None:
+            # every relation of the endpoint may fall back to this one
+            self._cache.pop(endpoint_name, None)
+        else:
+            self._cache.get(endpoint_name, {}).pop(relation_id, None)
+
+    def _get(self, key: _BindingKey) -> Optional["_AnyNetwork"]:
+        for layer in reversed(self._layers):
+            if key in layer:
+                return layer[key]
+        return None
+
+    def _set(self, key: _BindingKey, network: Optional["_AnyNetwork"]):
+        self._invalidate(key)
+        if network is None and len(self._layers) == 1:
+            # no layer below that we'd need to mask
+            self._layers[0].pop(key, None)
+        else:
+            self._layers[-1][key] = network
+
+    def network_get(
+        self, endpoint_name: str, relation_id: Optional[int] = None
+    ) -> "_Network":
+        """Get the network for an endpoint; mirrors `_ModelBackend.network_get`."""
+        stats = self.stats or _STATS
+        if stats is None:
+            return self._lookup(endpoint_name, relation_id)
+
+        start = perf_counter()
+        try:
+            network = self._lookup(endpoint_name, relation_id)
+        except NetworkingError:
+            stats.record(endpoint_name, perf_counter() - start, miss=True)
+            raise
+        elapsed = perf_counter() - start
+        fallback = relation_id is not None and not self._get(
+            (endpoint_name, relation_id)
+        )
+        stats.record(endpoint_name, elapsed, fallback=fallback)
+        return network
+
+    def _lookup(self, endpoint_name: str, relation_id: Optional[int]) -> "_Network":
+        try:
+            network = self._cache[endpoint_name][relation_id]
+        except KeyError:
+            pass
+        else:
+            self._hits += 1
+            return network
+
+        self._misses += 1
+        found = self._get((endpoint_name, relation_id))
+        if not found:
+            # fall back to default binding for relation:
+            found = self._get((endpoint_name, None))
+        if not found:
+            raise NetworkingError(
+                f"No network for {endpoint_name} -r {relation_id}; "
+                f"try `add_network({endpoint_name}, {relation_id} | None, Network(...))`"
+            )
+        network = _as_dict(found)
+        self._cache.setdefault(endpoint_name, {})[relation_id] = network
+        return network
+
+    def add_network(
+        self,
+        endpoint_name: str,
+        relation_id: Optional[int],
+        network: "_AnyNetwork",
+        make_default=False,
+    ):
+        """Add a network to this registry; see the module-level `add_network`."""
+        if self._get((endpoint_name, relation_id)):
+            log.warning(
+                f"Endpoint {endpoint_name} is already bound "
+                f"to a network for relation id {relation_id}."
+                f"Overwriting..."
+            )
+
+        self._set((endpoint_name, relation_id), network)
+
+        if relation_id is not None and make_default:
+            # make it default as well
+            self._set((endpoint_name, None), network)
+
+    def remove_network(self, endpoint_name: str, relation_id: Optional[int]):
+        """Remove a network from this registry."""
+        key = (endpoint_name, relation_id)
+        if not self._get(key):
+            raise KeyError(key)
+        self._set(key, None)
+
+    def add_networks(
+        self,
+        networks: Dict["_Binding", "_AnyNetwork"],
+        make_default: bool = False,
+    ):
+        """Add many networks at once.
+
+        Keys are endpoint names, relations or (name, relation id) pairs.
+        """
+        for binding, network in networks.items():
+            name, bind_id = _binding_key(binding)
+            self.add_network(name, bind_id, network, make_default=make_default)
+
+
+def _binding_key(binding: "_Binding") -> _BindingKey:
+    if isinstance(binding, str):
+        return binding, None
+    elif isinstance(binding, Relation):
+        return binding.name, binding.id
+    elif isinstance(binding, tuple):
+        return binding
+    raise TypeError(binding)
+
+
+def activate(juju_info_network: "_AnyNetwork" = JUJU_INFO) -> NetworkRegistry:
+    """Patches harness.backend.network_get and initializes the juju-info binding.
+
+    Returns the global registry.
+    """
     global PATCH_ACTIVE, _NETWORKS
     if PATCH_ACTIVE:
         raise NetworkingError("patch already active")
@@ -59,11 +322,11 @@ def activate(juju_info_network: "_Network" = JUJU_INFO):
 
     from ops.testing import _TestingModelBackend
 
-    _NETWORKS = defaultdict(dict)
+    _NETWORKS = NetworkRegistry(juju_info_network)
     _TestingModelBackend.network_get = _network_get  # type: ignore
-    _NETWORKS["juju-info"][None] = juju_info_network
 
     PATCH_ACTIVE = True
+    return _NETWORKS
 
 
 def deactivate():
@@ -75,7 +338,7 @@ def deactivate():
     _NETWORKS = None  # type: ignore
 
 
-_NETWORKS = None  # type: Optional[Dict[str, Dict[Optional[int], _Network]]]
+_NETWORKS = None  # type: Optional[NetworkRegistry]
 PATCH_ACTIVE = False
 
 
@@ -83,26 +346,107 @@ def _network_get(_, endpoint_name, relation_id=None) -> _Network:
     if not PATCH_ACTIVE:
         raise NotImplementedError("network-get")
     assert _NETWORKS  # type guard
+    return _NETWORKS.network_get(endpoint_name, relation_id)
 
-    try:
-        endpoints = _NETWORKS[endpoint_name]
-        network = endpoints.get(relation_id)
-        if not network:
-            # fall back to default binding for relation:
-            return endpoints[None]
-        return network
-    except KeyError as e:
+
+_STATS = None  # type: Optional[NetworkStats]
+
+
+def collect_stats(
+    stats: Optional[NetworkStats] = None, harness: Optional["Harness"] = None
+) -> NetworkStats:
+    """Start collecting `network_get` statistics.
+
+    If `harness` is given, only for that (attached) harness; otherwise for
+    all registries, global and per-harness, that don't collect their own.
+    Collection is off by default; it costs a bit of time on every call.
+
+    Example usage, e.g. in a session-scoped fixture:
+    >>> stats = collect_stats()
+    >>> yield
+    >>> stop_collecting_stats()
+    >>> stats.to_json("./network-stats.json")
+    """
+    global _STATS
+    stats = stats or NetworkStats()
+    if harness is None:
+        _STATS = stats
+    else:
+        _registry(harness).stats = stats
+    return stats
+
+
+def stop_collecting_stats(harness: Optional["Harness"] = None):
+    """Undo `collect_stats`."""
+    global _STATS
+    if harness is None:
+        _STATS = None
+    else:
+        _registry(harness).stats = None
+
+
+def attach(
+    harness: "Harness",
+    juju_info_network: Optional["_AnyNetwork"] = JUJU_INFO,
+    networks: Optional[Dict["_Binding", "_AnyNetwork"]] = None,
+    make_default: bool = False,
+) -> NetworkRegistry:
+    """Give `harness` a network registry of its own.
+
+    Unlike `activate`, this only patches the backend of this one Harness, so
+    any number of attached Harnesses can be used side by side (e.g. in
+    parallel threads). Attached Harnesses ignore the global registry.
+
+    Arguments: see `networking`.
+    Returns the registry; use it (or `add_network(..., harness=harness)`)
+    to add or remove networks later on.
+    """
+    backend = harness._backend
+    if _get_registry(harness) is not None:
+        raise NetworkingError(f"{harness} already has networking attached")
+
+    registry = NetworkRegistry(juju_info_network)
+    if networks:
+        registry.add_networks(networks, make_default=make_default)
+    # instance attribute shadows _TestingModelBackend.network_get, so the
+    # lookup for this backend goes straight to its own registry.
+    backend.network_get = registry.network_get  # type: ignore
+    return registry
+
+
+def detach(harness: "Harness"):
+    """Undo `attach`."""
+    if _get_registry(harness) is None:
+        raise NetworkingError(f"{harness} has no networking attached")
+    del harness._backend.network_get  # type: ignore
+
+
+def _get_registry(harness: "Harness") -> Optional[NetworkRegistry]:
+    network_get = vars(harness._backend).get("network_get")
+    return getattr(network_get, "__self__", None)
+
+
+def _registry(harness: Optional["Harness"]) -> NetworkRegistry:
+    if harness is None:
+        if not PATCH_ACTIVE:
+            raise NetworkingError("module not initialized; " "run activate() first.")
+        assert _NETWORKS  # type guard
+        return _NETWORKS
+
+    registry = _get_registry(harness)
+    if registry is None:
         raise NetworkingError(
-            f"No network for {endpoint_name} -r {relation_id}; "
-            f"try `add_network({endpoint_name}, {relation_id} | None, Network(...))`"
-        ) from e
+            f"{harness} has no networking attached; run attach() first."
+        )
+    return registry
 
 
 def add_network(
     endpoint_name: str,
     relation_id: Optional[int],
-    network: _Network,
+    network: "_AnyNetwork",
     make_default=False,
+    harness: Optional["Harness"] = None,
 ):
     """Add a network to the harness.
 
@@ -112,34 +456,170 @@ def add_network(
     - `network`: network data.
     - `make_default`: Make this the default network for the endpoint.
        Equivalent to calling this again with `relation_id==None`.
+    - `harness`: add the network to this (attached) harness only, instead of
+       to the global registry.
     """
-    if not PATCH_ACTIVE:
-        raise NetworkingError("module not initialized; " "run activate() first.")
-    assert _NETWORKS  # type guard
+    _registry(harness).add_network(
+        endpoint_name, relation_id, network, make_default=make_default
+    )
 
-    if _NETWORKS[endpoint_name].get(relation_id):
-        log.warning(
-            f"Endpoint {endpoint_name} is already bound "
-            f"to a network for relation id {relation_id}."
-            f"Overwriting..."
-        )
 
-    _NETWORKS[endpoint_name][relation_id] = network
+def remove_network(
+    endpoint_name: str,
+    relation_id: Optional[int],
+    harness: Optional["Harness"] = None,
+):
+    """Remove a network from the harness."""
+    _registry(harness).remove_network(endpoint_name, relation_id)
+
 
-    if relation_id and make_default:
-        # make it default as well
-        _NETWORKS[endpoint_name][None] = network
+_NETWORK_KEYS = (
+    "bind-addresses",
+    "bind-address",
+    "egress-subnets",
+    "ingress-addresses",
+)
 
 
-def remove_network(endpoint_name: str, relation_id: Optional[int]):
-    """Remove a network from the harness."""
-    if not PATCH_ACTIVE:
-        raise NetworkingError("module not initialized; " "run activate() first.")
-    assert _NETWORKS  # type guard
+def _address(value: Union[str, "_IPAddress"]) -> Union[str, "_IPAddress"]:
+    if isinstance(value, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+        return value
+    try:
+        return ipaddress.ip_address(value)
+    except ValueError:
+        # ops is lenient about this as well
+        return value
+
+
+@lru_cache(maxsize=4096)
+def _subnet(value: Union[str, "_IPNetwork"]) -> Union[str, "_IPNetwork"]:
+    # cached, so that equal subnets share a single instance
+    try:
+        return ipaddress.ip_network(value)
+    except ValueError:
+        return value
+
+
+class FrozenNetwork(Mapping):
+    """Immutable, compact network; see `Network`.
+
+    Stores addresses as `ipaddress` objects. It can be used as a (read-only)
+    `network-get` dict, but that dict is only built when first needed, for
+    example when `network_get` returns it, and then reused.
+    """
 
-    _NETWORKS[endpoint_name].pop(relation_id)
-    if not _NETWORKS[endpoint_name]:
-        del _NETWORKS[endpoint_name]
+    __slots__ = (
+        "bind_address",
+        "ingress_addresses",
+        "egress_subnets",
+        "cidr",
+        "mac_address",
+        "hostname",
+        "interface_name",
+        "_dict",
+    )
+
+    def __init__(
+        self,
+        bind_address: Union[str, "_IPAddress"],
+        ingress_addresses: Iterable[Union[str, "_IPAddress"]] = (),
+        egress_subnets: Iterable[Union[str, "_IPNetwork"]] = (),
+        cidr: Optional[Union[str, "_IPNetwork"]] = None,
+        mac_address: str = "",
+        hostname: str = "",
+        interface_name: str = "",
+    ):
+        _set = object.__setattr__
+        _set(self, "bind_address", _address(bind_address))
+        _set(self, "ingress_addresses", tuple(map(_address, ingress_addresses)))
+        _set(self, "egress_subnets", tuple(map(_subnet, egress_subnets)))
+        _set(self, "cidr", _subnet(cidr) if cidr else None)
+        _set(self, "mac_address", mac_address)
+        _set(self, "hostname", hostname)
+        _set(self, "interface_name", interface_name)
+        _set(self, "_dict", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def _fields(self) -> tuple:
+        return (
+            self.bind_address,
+            self.ingress_addresses,
+            self.egress_subnets,
+            self.cidr,
+            self.mac_address,
+            self.hostname,
+            self.interface_name,
+        )
+
+    def __reduce__(self):
+        return type(self), self._fields()
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __eq__(self, other):
+        if isinstance(other, FrozenNetwork):
+            return self._fields() == other._fields()
+        return super().__eq__(other)
+
+    def __hash__(self):
+        return hash(self._fields())
+
+    def __repr__(self):
+        return f"<FrozenNetwork {self.bind_address}>"
+
+    def __getitem__(self, key: str):
+        return self.as_dict()[key]
+
+    def __iter__(self):
+        return iter(_NETWORK_KEYS)
+
+    def __len__(self):
+        return len(_NETWORK_KEYS)
+
+    def as_dict(self) -> "_Network":
+        """Return the `network-get` form of this network.
+
+        The dict is cached, so treat it as read-only.
+        """
+        network = self._dict
+        if network is None:
+            bind_address = str(self.bind_address)
+            network = {
+                "bind-addresses": [
+                    {
+                        "mac-address": self.mac_address,
+                        "interface-name": self.interface_name,
+                        "interfacename": self.interface_name,
+                        "addresses": [
+                            {
+                                "hostname": self.hostname,
+                                "value": bind_address,
+                                "cidr": str(self.cidr) if self.cidr else "",
+                            }
+                        ],
+                    }
+                ],
+                "bind-address": bind_address,
+                "egress-subnets": [str(subnet) for subnet in self.egress_subnets],
+                "ingress-addresses": [str(addr) for addr in self.ingress_addresses],
+            }  # type: _Network
+            object.__setattr__(self, "_dict", network)
+        return network
+
+
+def _as_dict(network: "_AnyNetwork") -> "_Network":
+    if isinstance(network, FrozenNetwork):
+        return network.as_dict()
+    return network
 
 
 def Network(
@@ -150,23 +630,268 @@ def Network(
     interface_name: str = "",
     egress_subnets=("1.1.1.2/32",),
     ingress_addresses=("1.1.1.2",),
-) -> _Network:
+) -> FrozenNetwork:
     """Construct a network object."""
-    return {
-        "bind-addresses": [
-            {
-                "mac-address": mac_address,
-                "interface-name": interface_name,
-                "interfacename": interface_name,
-                "addresses": [
-                    {"hostname": hostname, "value": private_address, "cidr": cidr}
-                ],
-            }
-        ],
-        "bind-address": private_address,
-        "egress-subnets": list(egress_subnets),
-        "ingress-addresses": list(ingress_addresses),
-    }
+    return FrozenNetwork(
+        bind_address=private_address,
+        ingress_addresses=ingress_addresses,
+        egress_subnets=egress_subnets,
+        cidr=cidr or None,
+        mac_address=mac_address,
+        hostname=hostname,
+        interface_name=interface_name,
+    )
+
+
+class NetworkPool:
+    """Hands out networks with unique addresses from a CIDR range.
+
+    Each network gets one host address out of `cidr`, which it uses as bind,
+    ingress and (/32 or /128) egress address. Addresses are generated lazily,
+    and released ones are reused before any new one is generated.
+
+    Example usage:
+    >>> pool = NetworkPool("10.0.0.0/16")
+    >>> for relation_id, network in zip(range(1000), pool):
+    ...     add_network("foo", relation_id, network)
+    >>> pool.release(charm.model.get_binding(relation).network.bind_address)
+    """
+
+    def __init__(self, cidr: str = "10.0.0.0/16"):
+        self.subnet = ipaddress.ip_network(cidr)
+        self._hosts = self.subnet.hosts()
+        self._free: Deque[_IPAddress] = deque()
+        self._allocated: Set[_IPAddress] = set()
+
+    def __len__(self):
+        """Return the number of addresses currently allocated."""
+        return len(self._allocated)
+
+    def allocate(self) -> "_IPAddress":
+        """Allocate a single address."""
+        if self._free:
+            address = self._free.popleft()
+        else:
+            address = next(self._hosts, None)
+            if address is None:
+                raise NetworkingError(f"address pool {self.subnet} exhausted")
+        self._allocated.add(address)
+        return address
+
+    def release(self, network: Union["_AnyNetwork", "_IPAddress", str]):
+        """Give back a network (or address) obtained from this pool."""
+        if isinstance(network, FrozenNetwork):
+            network = network.bind_address
+        elif isinstance(network, Mapping):
+            network = network["bind-address"]
+        address = ipaddress.ip_address(network)
+        try:
+            self._allocated.remove(address)
+        except KeyError:
+            raise NetworkingError(
+                f"{address} was not allocated from {self.subnet}"
+            ) from None
+        self._free.append(address)
+
+    def network(self, **kwargs) -> FrozenNetwork:
+        """Allocate a network; `kwargs` are passed on to `FrozenNetwork`."""
+        address = self.allocate()
+        return FrozenNetwork(
+            bind_address=address,
+            ingress_addresses=(address,),
+            egress_subnets=(ipaddress.ip_network((address, address.max_prefixlen)),),
+            cidr=self.subnet,
+            **kwargs,
+        )
+
+    def networks(self, count: int, **kwargs) -> List[FrozenNetwork]:
+        """Allocate `count` networks at once."""
+        return [self.network(**kwargs) for _ in range(count)]
+
+    def __iter__(self) -> Iterator[FrozenNetwork]:
+        """Allocate networks, one at a time, until the pool is exhausted."""
+        while True:
+            try:
+                network = self.network()
+            except NetworkingError:
+                return
+            yield network
+
+
+class _Provisioner:
+    """Gives each relation added to a harness a network from a NetworkPool."""
+
+    _PATCHED = ("add_relation", "remove_relation", "add_relation_unit")
+
+    def __init__(self, harness: "Harness", pool: NetworkPool):
+        self.harness = harness
+        self.pool = pool
+        # {relation id: (registry, endpoint, network)}
+        self._networks: Dict[int, Tuple[NetworkRegistry, str, FrozenNetwork]] = {}
+        self._add_relation = harness.add_relation
+        self._remove_relation = harness.remove_relation
+        self._add_relation_unit = harness.add_relation_unit
+
+    def _registry(self) -> NetworkRegistry:
+        return _get_registry(self.harness) or _registry(None)
+
+    def _provision(
+        self,
+        registry: NetworkRegistry,
+        endpoint: str,
+        relation_id: int,
+        network: FrozenNetwork,
+    ):
+        registry.add_network(endpoint, relation_id, network)
+        self._networks[relation_id] = (registry, endpoint, network)
+
+    def _unprovision(self, relation_id: int):
+        provisioned = self._networks.pop(relation_id, None)
+        if provisioned is None:
+            return
+        registry, endpoint, network = provisioned
+        try:
+            registry.remove_network(endpoint, relation_id)
+        except KeyError:
+            pass  # already removed, or dropped by a networking() scope
+        self.pool.release(network)
+
+    # the wrappers pass on whatever other arguments the Harness methods take,
+    # as their signatures vary across ops versions
+
+    def add_relation(self, relation_name: str, remote_app: str, *args, **kwargs) -> int:
+        # fail before adding the relation if it can't get a network, and add
+        # it before calling through: relation-created is emitted in there, and
+        # its handlers may already look the network up
+        registry = self._registry()
+        network = self.pool.network()
+        relation_id = self.harness._relation_id_counter
+        self._provision(registry, relation_name, relation_id, network)
+        try:
+            return self._add_relation(relation_name, remote_app, *args, **kwargs)
+        except BaseException:
+            self._unprovision(relation_id)
+            raise
+
+    def add_relation_unit(self, relation_id: int, *args, **kwargs) -> None:
+        # relations added before provisioning started get a network now,
+        # unless one was added for them by hand
+        if relation_id not in self._networks:
+            endpoint = self.harness._backend._relation_names[relation_id]
+            registry = self._registry()
+            if registry._get((endpoint, relation_id)) is None:
+                self._provision(registry, endpoint, relation_id, self.pool.network())
+        return self._add_relation_unit(relation_id, *args, **kwargs)
+
+    def remove_relation(self, relation_id: int, *args, **kwargs) -> None:
+        # the relation-broken hooks may still look the network up
+        self._remove_relation(relation_id, *args, **kwargs)
+        self._unprovision(relation_id)
+
+
+def auto_provision(
+    harness: "Harness", pool: Optional[NetworkPool] = None
+) -> NetworkPool:
+    """Give every relation added to `harness` a network of its own.
+
+    From now on, `harness.add_relation` allocates a network from `pool` (by
+    default, a new `NetworkPool()`) and adds it for the new relation, to the
+    harness's registry if it's attached (see `attach`), else to the global
+    one. `harness.remove_relation` releases it. `add_relation_unit`
+    provisions relations that were added before this was called.
+    Returns the pool.
+
+    Example usage:
+    >>> with networking(harness=harness):
+    >>>     auto_provision(harness, NetworkPool("10.1.0.0/16"))
+    >>>     relation_id = harness.add_relation("db", "remote")
+    >>>     relation = harness.model.get_relation("db", relation_id)
+    >>>     assert harness.model.get_binding(relation).network.bind_address
+    """
+    if _get_provisioner(harness) is not None:
+        raise NetworkingError(f"{harness} is already auto-provisioned")
+    provisioner = _Provisioner(harness, NetworkPool() if pool is None else pool)
+    for name in _Provisioner._PATCHED:
+        setattr(harness, name, getattr(provisioner, name))
+    return provisioner.pool
+
+
+def stop_auto_provisioning(harness: "Harness"):
+    """Undo `auto_provision`; networks provisioned so far are left in place."""
+    if _get_provisioner(harness) is None:
+        raise NetworkingError(f"{harness} is not auto-provisioned")
+    for name in _Provisioner._PATCHED:
+        delattr(harness, name)
+
+
+def _get_provisioner(harness: "Harness") -> Optional[_Provisioner]:
+    add_relation = vars(harness).get("add_relation")
+    return getattr(add_relation, "__self__", None)
+
+
+# {(path, mtime, size): topology}
+_TOPOLOGIES = {}  # type: Dict[Tuple[str, int, int], Mapping[_BindingKey, _Network]]
+
+
+def load_topology(path: Union[str, Path]) -> Mapping[_BindingKey, "_Network"]:
+    """Load a topology: a set of `network-get` outputs, e.g. recorded from a live model.
+
+    Supported formats are `.json` and `.yaml`/`.yml` files shaped like:
+    >>> {"endpoint": {"default": {...network-get output...}, "3": {...}}}
+    where "default" (or null) is the default network for the endpoint, and
+    integer keys are relation IDs; and `.jsonl` files, with one
+    >>> {"endpoint": "endpoint", "relation-id": 3, "network": {...}}
+    object per line, which are read in a streaming fashion.
+
+    Topologies are cached per file (until it is modified), so loading the
+    same one in many tests only parses it once. Pass the result as
+    `networks` to `networking` or `attach`:
+    >>> with networking(networks=load_topology("./my-model.json")):
+    ...     ...
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+    topology = _TOPOLOGIES.get(key)
+    if topology is None:
+        topology = MappingProxyType(dict(_parse_topology(path)))
+        _TOPOLOGIES[key] = topology
+    return topology
+
+
+def _parse_topology(path: Path) -> Iterator[Tuple[_BindingKey, "_Network"]]:
+    suffix = path.suffix.lower()
+    if suffix == ".jsonl":
+        with path.open() as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                relation_id = _topology_relation_id(record.get("relation-id"))
+                yield (record["endpoint"], relation_id), record["network"]
+        return
+
+    if suffix == ".json":
+        with path.open() as f:
+            data = json.load(f)
+    elif suffix in (".yaml", ".yml"):
+        import yaml
+
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        with path.open() as f:
+            data = yaml.load(f, Loader=loader)
+    else:
+        raise NetworkingError(f"unsupported topology format: {path}")
+
+    for endpoint, networks in data.items():
+        for relation_id, network in networks.items():
+            yield (endpoint, _topology_relation_id(relation_id)), network
+
+
+def _topology_relation_id(value: Union[str, int, None]) -> Optional[int]:
+    if value is None or value in ("default", "null", ""):
+        return None
+    return int(value)
 
 
 _not_given = object()  # None is meaningful, but JUJU_INFO is mutable
@@ -174,17 +899,25 @@ _not_given = object()  # None is meaningful, but JUJU_INFO is mutable
 
 @contextmanager
 def networking(
-    juju_info_network: Optional[_Network] = _not_given,  # type: ignore
-    networks: Optional[Dict[Union[str, Relation], _Network]] = None,
+    juju_info_network: Optional["_AnyNetwork"] = _not_given,  # type: ignore
+    networks: Optional[Dict["_Binding", "_AnyNetwork"]] = None,
     make_default: bool = False,
+    harness: Optional["Harness"] = None,
 ):
     """Context manager to activate/deactivate networking within a scope.
 
     Arguments:
         - `juju_info_network`: network assigned to the implicit 'juju-info' endpoint.
-        - `networks`: mapping from endpoints (names, or relations) to networks.
+        - `networks`: mapping from endpoints (names, relations, or
+          (name, relation id) pairs) to networks. See also `load_topology`.
         - `make_default`: whether the networks passed as relations should also
           be interpreted as default networks for the endpoint.
+        - `harness`: scope the networks of this harness (see `attach`) instead
+          of the global ones.
+
+    Nested scopes only pay for what they change: any change made within a
+    scope (including `add_network`/`remove_network` calls) is undone when
+    it exits, whether or not it raised.
 
     Example usage:
     >>> with networking():
@@ -206,35 +939,36 @@ def networking(
     >>>     # assert charm.model.get_binding(bar_relation).network.private_address
 
     """
-    global _NETWORKS
-    old = deepcopy(_NETWORKS)
-    patch_was_inactive = False
-
     if juju_info_network is _not_given:
         juju_info_network = JUJU_INFO
 
-    if not PATCH_ACTIVE:
-        patch_was_inactive = True
-        activate(juju_info_network or JUJU_INFO)
+    if harness is not None:
+        registry = _get_registry(harness)
+        scope_owner = registry is None
+        if scope_owner:
+            registry = attach(harness, juju_info_network)
     else:
-        assert _NETWORKS  # type guard
-
+        registry = _NETWORKS
+        scope_owner = not PATCH_ACTIVE
+        if scope_owner:
+            activate(juju_info_network or JUJU_INFO)
+            registry = _NETWORKS
+
+    assert registry  # type guard
+    if not scope_owner:
+        registry.push()
         if juju_info_network:
-            _NETWORKS["juju-info"][None] = juju_info_network
-
-    for binding, network in networks.items() if networks else ():
-        if isinstance(binding, str):
-            name = binding
-            bind_id = None
-        elif isinstance(binding, Relation):
-            name = binding.name
-            bind_id = binding.id
-        else:
-            raise TypeError(binding)
-        add_network(name, bind_id, network, make_default=make_default)
+            registry._set(("juju-info", None), juju_info_network)
 
-    yield
-
-    _NETWORKS = old
-    if patch_was_inactive:
-        deactivate()
+    try:
+        if networks:
+            registry.add_networks(networks, make_default=make_default)
+        yield registry
+
+    finally:
+        if not scope_owner:
+            registry.pop()
+        elif harness is not None:
+            detach(harness)
+        else:
+            deactivate()
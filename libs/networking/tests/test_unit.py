@@ -1,9 +1,13 @@
 # add here your unittests
+import json
+import pickle
 import sys
+from copy import deepcopy
 from ipaddress import IPv4Address
 from pathlib import Path
 
 import pytest as pytest
+import yaml
 from ops.charm import CharmBase, ConfigChangedEvent, RelationEvent
 from ops.model import Relation
 from ops.testing import Harness
@@ -14,11 +18,19 @@ sys.path.append(str(lib_root))
 from networking import (
     Network,
     NetworkingError,
+    NetworkPool,
     activate,
     add_network,
+    attach,
+    auto_provision,
+    collect_stats,
     deactivate,
+    detach,
+    load_topology,
     networking,
     remove_network,
+    stop_auto_provisioning,
+    stop_collecting_stats,
 )
 
 
@@ -223,3 +235,441 @@ def test_dynamic_add_remove():
         remove_network("foo", None)
         with pytest.raises(NetworkingError):
             _ = c.model.get_binding("foo").network
+
+
+def test_attach_per_harness():
+    class Charm(CharmBase):
+        pass
+
+    h1: Harness[Charm] = Harness(Charm)
+    h2: Harness[Charm] = Harness(Charm)
+    h1.begin()
+    h2.begin()
+
+    attach(h1, networks={"foo": Network(private_address="42.42.42.42")})
+    attach(h2, networks={"foo": Network(private_address="43.43.43.43")})
+
+    assert h1.charm.model.get_binding("foo").network.bind_address == IPv4Address(
+        "42.42.42.42"
+    )
+    assert h2.charm.model.get_binding("foo").network.bind_address == IPv4Address(
+        "43.43.43.43"
+    )
+    add_network("bar", None, Network(private_address="44.44.44.44"), harness=h2)
+    assert h2.charm.model.get_binding("bar").network.bind_address == IPv4Address(
+        "44.44.44.44"
+    )
+    with pytest.raises(NetworkingError):
+        _ = h1.charm.model.get_binding("bar").network
+
+    with pytest.raises(NetworkingError):
+        attach(h1)
+    detach(h1)
+    detach(h2)
+    with pytest.raises(NotImplementedError):
+        _ = h1.charm.model.get_binding("juju-info").network
+
+
+def test_attach_ignores_global_patch():
+    class Charm(CharmBase):
+        pass
+
+    h: Harness[Charm] = Harness(Charm)
+    h.begin()
+    attach(h, juju_info_network=Network(private_address="42.42.42.42"))
+
+    with networking():
+        assert h.charm.model.get_binding(
+            "juju-info"
+        ).network.bind_address == IPv4Address("42.42.42.42")
+
+
+def test_attach_threads():
+    from concurrent.futures import ThreadPoolExecutor
+
+    class Charm(CharmBase):
+        pass
+
+    def scenario(i: int):
+        h: Harness[Charm] = Harness(Charm)
+        h.begin()
+        address = f"10.0.0.{i}"
+        attach(h, networks={"foo": Network(private_address=address)})
+        return h.charm.model.get_binding("foo").network.bind_address == IPv4Address(
+            address
+        )
+
+    with ThreadPoolExecutor(8) as pool:
+        assert all(pool.map(scenario, range(1, 33)))
+
+
+def test_nested_scopes():
+    class Charm(CharmBase):
+        pass
+
+    h: Harness[Charm] = Harness(Charm)
+    h.begin()
+
+    def bind_address(endpoint):
+        # bypass the model's binding cache
+        return h._backend.network_get(endpoint)["bind-address"]
+
+    with networking(networks={"foo": Network(private_address="42.42.42.42")}):
+        with networking(networks={"foo": Network(private_address="43.43.43.43")}):
+            assert bind_address("foo") == "43.43.43.43"
+            remove_network("foo", None)
+            with pytest.raises(NetworkingError):
+                bind_address("foo")
+            add_network("bar", None, Network(private_address="44.44.44.44"))
+
+        assert bind_address("foo") == "42.42.42.42"
+        with pytest.raises(NetworkingError):
+            bind_address("bar")
+
+        with pytest.raises(ValueError):
+            with networking(juju_info_network=Network(private_address="45.45.45.45")):
+                assert bind_address("juju-info") == "45.45.45.45"
+                raise ValueError()
+
+        assert bind_address("juju-info") == "1.1.1.1"
+
+
+def test_harness_scope():
+    class Charm(CharmBase):
+        pass
+
+    h: Harness[Charm] = Harness(Charm)
+    h.begin()
+
+    with networking(
+        harness=h, networks={"foo": Network(private_address="42.42.42.42")}
+    ):
+        with networking(
+            harness=h, networks={"foo": Network(private_address="43.43.43.43")}
+        ):
+            assert h._backend.network_get("foo")["bind-address"] == "43.43.43.43"
+        assert h._backend.network_get("foo")["bind-address"] == "42.42.42.42"
+
+    with pytest.raises(NotImplementedError):
+        h._backend.network_get("foo")
+
+
+def test_network_pool():
+    pool = NetworkPool("10.0.0.0/16")
+    networks = pool.networks(1000)
+    addresses = {network["bind-address"] for network in networks}
+    assert len(addresses) == len(pool) == 1000
+    assert networks[0]["ingress-addresses"] == ["10.0.0.1"]
+    assert networks[0]["egress-subnets"] == ["10.0.0.1/32"]
+    assert networks[0]["bind-addresses"][0]["addresses"][0]["cidr"] == "10.0.0.0/16"
+
+    pool.release(networks[41])
+    assert len(pool) == 999
+    # released addresses are reused first
+    assert pool.network()["bind-address"] == networks[41]["bind-address"]
+
+    with pytest.raises(NetworkingError):
+        pool.release("10.1.0.1")
+
+
+def test_network_pool_exhausted():
+    pool = NetworkPool("10.0.0.0/29")
+    assert len(list(pool)) == 6
+    with pytest.raises(NetworkingError):
+        pool.network()
+    pool.release("10.0.0.3")
+    assert pool.network()["bind-address"] == "10.0.0.3"
+
+
+def test_network_pool_binding():
+    class Charm(CharmBase):
+        pass
+
+    h: Harness[Charm] = Harness(Charm)
+    h.begin()
+    pool = NetworkPool("192.168.0.0/24")
+    with networking(harness=h) as registry:
+        for relation_id, network in zip(range(10), pool):
+            registry.add_network("foo", relation_id, network)
+        assert h._backend.network_get("foo", 9)["bind-address"] == "192.168.0.10"
+
+
+def test_frozen_network():
+    network = Network(private_address="42.42.42.42", egress_subnets=("10.0.0.0/24",))
+    assert network.bind_address == IPv4Address("42.42.42.42")
+    with pytest.raises(AttributeError):
+        network.bind_address = IPv4Address("1.1.1.1")
+
+    # the dict form is built once, and only on demand
+    assert network.as_dict() is network.as_dict()
+    assert network["bind-address"] == "42.42.42.42"
+    assert network == {
+        "bind-addresses": [
+            {
+                "mac-address": "",
+                "interface-name": "",
+                "interfacename": "",
+                "addresses": [{"hostname": "", "value": "42.42.42.42", "cidr": ""}],
+            }
+        ],
+        "bind-address": "42.42.42.42",
+        "egress-subnets": ["10.0.0.0/24"],
+        "ingress-addresses": ["1.1.1.2"],
+    }
+
+    other = Network(private_address="42.42.42.42", egress_subnets=("10.0.0.0/24",))
+    assert other == network
+    assert hash(other) == hash(network)
+    # shared subnets are interned
+    assert other.egress_subnets[0] is network.egress_subnets[0]
+
+    assert deepcopy(network) is network
+    assert pickle.loads(pickle.dumps(network)) == network
+
+
+def test_frozen_network_get():
+    class Charm(CharmBase):
+        pass
+
+    h: Harness[Charm] = Harness(Charm)
+    h.begin()
+    network = Network(private_address="42.42.42.42")
+    with networking(harness=h, networks={"foo": network}):
+        assert h._backend.network_get("foo") is network.as_dict()
+        assert h.charm.model.get_binding("foo").network.bind_address == IPv4Address(
+            "42.42.42.42"
+        )
+
+
+def test_network_get_cache():
+    class Charm(CharmBase):
+        pass
+
+    h: Harness[Charm] = Harness(Charm)
+    h.begin()
+
+    def bind_address(endpoint, relation_id=None):
+        return h._backend.network_get(endpoint, relation_id)["bind-address"]
+
+    with networking(
+        harness=h, networks={"foo": Network(private_address="42.42.42.42")}
+    ) as registry:
+        assert bind_address("foo", 1) == "42.42.42.42"
+        assert bind_address("foo", 1) == "42.42.42.42"
+        assert registry.cache_info() == (1, 1, 1)
+
+        # a relation-specific network only affects its own relation
+        add_network("foo", 2, Network(private_address="43.43.43.43"), harness=h)
+        assert bind_address("foo", 2) == "43.43.43.43"
+        assert bind_address("foo", 1) == "42.42.42.42"
+        assert registry.cache_info() == (2, 2, 2)
+
+        # a new default affects all of them
+        with networking(
+            harness=h, networks={"foo": Network(private_address="44.44.44.44")}
+        ):
+            assert bind_address("foo", 1) == "44.44.44.44"
+            assert bind_address("foo", 2) == "43.43.43.43"
+        assert bind_address("foo", 1) == "42.42.42.42"
+
+        remove_network("foo", 2, harness=h)
+        assert bind_address("foo", 2) == "42.42.42.42"
+
+        registry.cache_clear()
+        assert registry.cache_info() == (0, 0, 0)
+
+
+@pytest.mark.parametrize("fmt", ("json", "yaml", "jsonl"))
+def test_load_topology(tmp_path, fmt):
+    default = Network(private_address="42.42.42.42").as_dict()
+    specific = Network(private_address="43.43.43.43").as_dict()
+
+    path = tmp_path / f"topology.{fmt}"
+    if fmt == "jsonl":
+        path.write_text(
+            "\n".join(
+                json.dumps({"endpoint": "foo", "relation-id": rid, "network": network})
+                for rid, network in ((None, default), (3, specific))
+            )
+        )
+    else:
+        data = {"foo": {"default": default, "3": specific}}
+        path.write_text(json.dumps(data) if fmt == "json" else yaml.safe_dump(data))
+
+    topology = load_topology(path)
+    assert topology == {("foo", None): default, ("foo", 3): specific}
+    # parsed only once
+    assert load_topology(str(path)) is topology
+
+    class Charm(CharmBase):
+        pass
+
+    h: Harness[Charm] = Harness(Charm)
+    h.begin()
+    with networking(harness=h, networks=topology):
+        assert h._backend.network_get("foo", 3)["bind-address"] == "43.43.43.43"
+        assert h._backend.network_get("foo", 4)["bind-address"] == "42.42.42.42"
+
+    # reloaded when the file changes
+    path.write_text(path.read_text().replace("43.43.43.43", "44.44.44.444"))
+    assert load_topology(path)[("foo", 3)]["bind-address"] == "44.44.44.444"
+
+
+def test_collect_stats(tmp_path):
+    class Charm(CharmBase):
+        pass
+
+    h: Harness[Charm] = Harness(Charm)
+    h.begin()
+
+    with networking(harness=h, networks={"foo": Network()}):
+        stats = collect_stats()
+        try:
+            h._backend.network_get("foo")
+            h._backend.network_get("foo", 1)
+            h._backend.network_get("foo", 1)
+            with pytest.raises(NetworkingError):
+                h._backend.network_get("bar")
+        finally:
+            stop_collecting_stats()
+        h._backend.network_get("foo")
+
+    dumped = stats.as_dict()
+    assert list(dumped) == ["foo", "bar"]
+    assert dumped["foo"]["calls"] == 3
+    assert dumped["foo"]["fallbacks"] == 2
+    assert dumped["foo"]["misses"] == 0
+    assert dumped["bar"] == {
+        "calls": 1,
+        "fallbacks": 0,
+        "misses": 1,
+        "time": dumped["bar"]["time"],
+    }
+
+    stats.to_json(tmp_path / "stats.json")
+    assert json.loads((tmp_path / "stats.json").read_text()) == dumped
+
+
+def test_collect_stats_per_harness():
+    class Charm(CharmBase):
+        pass
+
+    h: Harness[Charm] = Harness(Charm)
+    h.begin()
+    attach(h)
+    stats = collect_stats(harness=h)
+    h._backend.network_get("juju-info")
+    stop_collecting_stats(harness=h)
+    h._backend.network_get("juju-info")
+    assert stats.as_dict()["juju-info"]["calls"] == 1
+
+
+def test_auto_provision():
+    class Charm(CharmBase):
+        def __init__(self, framework, key=None):
+            super().__init__(framework, key)
+            self.addresses = []
+            self.framework.observe(self.on.foo_relation_broken, self._on_broken)
+
+        def _on_broken(self, event):
+            binding = self.model.get_binding(event.relation)
+            self.addresses.append(str(binding.network.bind_address))
+
+    h: Harness[Charm] = Harness(
+        Charm, meta=yaml.safe_dump({"requires": {"foo": {"interface": "foo"}}})
+    )
+    h.begin()
+    before = h.add_relation("foo", "remote")
+    manual = h.add_relation("foo", "manual")
+
+    with networking(harness=h) as registry:
+        pool = auto_provision(h, NetworkPool("192.168.0.0/24"))
+        with pytest.raises(NetworkingError):
+            auto_provision(h)
+
+        # a failed add_relation doesn't keep its address
+        with pytest.raises(Exception):
+            h.add_relation("nope", "remote")
+        assert len(pool) == 0
+
+        relation_ids = [h.add_relation("foo", f"remote{i}") for i in range(3)]
+        assert len(pool) == 3
+        assert [
+            registry.network_get("foo", rid)["bind-address"] for rid in relation_ids
+        ] == [
+            "192.168.0.1",
+            "192.168.0.2",
+            "192.168.0.3",
+        ]
+
+        # added before provisioning: gets a network when a unit joins
+        h.add_relation_unit(before, remote_unit_name="remote/0")
+        assert registry.network_get("foo", before)["bind-address"] == "192.168.0.4"
+
+        # unless one was added for it by hand
+        registry.add_network("foo", manual, Network(private_address="42.42.42.42"))
+        h.add_relation_unit(manual, remote_unit_name="manual/0")
+        assert registry.network_get("foo", manual)["bind-address"] == "42.42.42.42"
+        assert len(pool) == 4
+
+        # still available to relation-broken handlers, released afterwards
+        h.remove_relation(relation_ids[0])
+        assert h.charm.addresses == ["192.168.0.1"]
+        assert len(pool) == 3
+        with pytest.raises(NetworkingError):
+            registry.network_get("foo", relation_ids[0])
+        assert (
+            registry.network_get("foo", h.add_relation("foo", "new"))["bind-address"]
+            == "192.168.0.1"
+        )
+
+        stop_auto_provisioning(h)
+        with pytest.raises(NetworkingError):
+            stop_auto_provisioning(h)
+        h.add_relation("foo", "unprovisioned")
+        assert len(pool) == 4
+
+
+def test_auto_provision_relation_created():
+    class Charm(CharmBase):
+        def __init__(self, framework, key=None):
+            super().__init__(framework, key)
+            self.addresses = []
+            self.framework.observe(self.on.foo_relation_created, self._on_created)
+
+        def _on_created(self, event):
+            binding = self.model.get_binding(event.relation)
+            self.addresses.append(str(binding.network.bind_address))
+
+    h: Harness[Charm] = Harness(
+        Charm, meta=yaml.safe_dump({"requires": {"foo": {"interface": "foo"}}})
+    )
+    h.begin()
+    with networking(harness=h):
+        pool = auto_provision(h, NetworkPool("192.168.0.0/24"))
+        h.add_relation("foo", "remote0")
+        h.add_relation("foo", "remote1")
+    assert h.charm.addresses == ["192.168.0.1", "192.168.0.2"]
+    assert len(pool) == 2
+
+
+def test_auto_provision_global():
+    class Charm(CharmBase):
+        pass
+
+    h: Harness[Charm] = Harness(
+        Charm, meta=yaml.safe_dump({"requires": {"foo": {"interface": "foo"}}})
+    )
+    h.begin()
+    auto_provision(h)
+    # nowhere to add networks to: the relation isn't added either
+    with pytest.raises(NetworkingError):
+        h.add_relation("foo", "remote")
+    assert not h.model.relations["foo"]
+
+    with networking():
+        relation_id = h.add_relation("foo", "remote")
+        relation = h.model.get_relation("foo", relation_id)
+        assert h.model.get_binding(relation).network.bind_address == IPv4Address(
+            "10.0.0.1"
+        )
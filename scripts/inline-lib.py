@@ -1,24 +1,43 @@
 #! /bin/python3
 
+import hashlib
+import json
 import os
-import sys
+import runpy
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
 
 import jinja2 as jinja2
 
 root = Path()
-
-
-def inline_lib(lib: str):
-    print(f"Rendering {lib} lib...")
-
-    lib_root = Path() / 'libs' / lib
-    sys.path.append(str(lib_root))
-
-    try:
-        import __version__  # noqa
-    except ModuleNotFoundError:
+# digests of the inputs of the last render of each lib
+manifest_file = root / "lib" / ".inline-lib-manifest.json"
+
+
+class LibSources(NamedTuple):
+    py: str
+    template: str
+    version: int
+    revision: int
+    lib_file: Path
+
+    @property
+    def digest(self) -> str:
+        hasher = hashlib.sha256()
+        for part in (self.py, self.template, f"{self.version}.{self.revision}"):
+            hasher.update(part.encode())
+            hasher.update(b"\0")
+        return hasher.hexdigest()
+
+
+def read_sources(lib: str) -> LibSources:
+    lib_root = root / "libs" / lib
+    version_file = lib_root / "__version__.py"
+    if not version_file.exists():
         raise ValueError(lib)
+    # run it rather than import it: no sys.path changes, no stale module cache
+    __version__ = runpy.run_path(str(version_file))
 
     lib_py_file = lib + ".py"
     py = lib_root / (lib_py_file)
@@ -32,26 +51,133 @@ def inline_lib(lib: str):
         / "lib"
         / "charms"
         / "harness_extensions"
-        / f"v{__version__.version}"
+        / f"v{__version__['version']}"
         / lib_py_file
     )
+    return LibSources(
+        py.read_text(),
+        template.read_text(),
+        __version__["version"],
+        __version__["revision"],
+        lib_file,
+    )
 
-    if not lib_file.parent.exists():
-        os.makedirs(lib_file.parent)
 
-    rendered = jinja2.Template(template.read_text()).render(
+def render(sources: LibSources) -> str:
+    return jinja2.Template(sources.template).render(
         {
-            "py": py.read_text(),
-            "revision": __version__.revision,
-            "version": __version__.version,
+            "py": sources.py,
+            "revision": sources.revision,
+            "version": sources.version,
         }
     )
+
+
+def all_libs() -> List[str]:
+    return sorted(
+        path.parent.name for path in (root / "libs").glob("*/lib_template.jinja")
+    )
+
+
+def load_manifest() -> Dict[str, str]:
+    try:
+        return json.loads(manifest_file.read_text())
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest: Dict[str, str]):
+    manifest_file.parent.mkdir(parents=True, exist_ok=True)
+    manifest_file.write_text(json.dumps(manifest, indent=2, sort_keys=True) + "\n")
+
+
+def write_lib(lib: str, sources: LibSources) -> str:
+    """Render `lib` to its lib file; return the digest of its sources."""
+    print(f"Rendering {lib} lib...")
+    rendered = render(sources)
+
+    lib_file = sources.lib_file
+    if not lib_file.parent.exists():
+        os.makedirs(lib_file.parent, exist_ok=True)
     print(f"Dropped {lib_file}.")
     lib_file.write_text(rendered)
+    return sources.digest
+
+
+def inline_lib(lib: str):
+    sources = read_sources(lib)
+    manifest = load_manifest()
+    manifest[lib] = write_lib(lib, sources)
+    save_manifest(manifest)
+
+
+def build(libs: Optional[List[str]] = None, force: bool = False):
+    """Render all `libs` (by default, all of them) in parallel.
+
+    Libs whose source, template and version haven't changed since they were
+    last rendered (and whose lib file is still there) are skipped, unless
+    `force` is set.
+    """
+    libs = libs or all_libs()
+    manifest = load_manifest()
+
+    with ThreadPoolExecutor() as pool:
+        all_sources = dict(zip(libs, pool.map(read_sources, libs)))
+        stale = {
+            lib: sources
+            for lib, sources in all_sources.items()
+            if force
+            or manifest.get(lib) != sources.digest
+            or not sources.lib_file.exists()
+        }
+        for lib in sorted(set(libs) - set(stale)):
+            print(f"{lib} lib is up to date.")
+        digests = pool.map(write_lib, stale, stale.values())
+        manifest.update(zip(stale, digests))
+
+    save_manifest(manifest)
+
+
+def check(libs: Optional[List[str]] = None) -> int:
+    """Report libs whose lib file doesn't match their sources; write nothing.
+
+    Returns the number of libs that drifted.
+    """
+    libs = libs or all_libs()
+
+    def _drifted(lib: str) -> Optional[str]:
+        sources = read_sources(lib)
+        if not sources.lib_file.exists():
+            return f"{lib}: {sources.lib_file} is missing"
+        if sources.lib_file.read_text() != render(sources):
+            return f"{lib}: {sources.lib_file} is out of date"
+        return None
+
+    with ThreadPoolExecutor() as pool:
+        drifted = [message for message in pool.map(_drifted, libs) if message]
+    for message in drifted:
+        print(message)
+    return len(drifted)
 
 
 if __name__ == "__main__":
     import typer
 
-    typer.run(inline_lib)
-
+    def main(
+        lib: Optional[str] = typer.Argument(
+            None, help="Lib to render. If omitted, render all (changed) libs."
+        ),
+        check_only: bool = typer.Option(
+            False, "--check", help="Only check that lib/ is up to date with libs/."
+        ),
+        force: bool = typer.Option(False, help="Render unchanged libs too."),
+    ):
+        libs = [lib] if lib else None
+        if check_only:
+            raise typer.Exit(1 if check(libs) else 0)
+        if lib:
+            inline_lib(lib)
+        else:
+            build(force=force)
+
+    typer.run(main)